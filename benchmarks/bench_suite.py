@@ -0,0 +1,172 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pandas as pd
+import psutil
+
+from benchmarks.synthetic import exceptions, generate
+from src.aggregator import DataAggregator
+from src.data_loader import DataLoader
+from src.store import product_of
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data')
+PARAMCODES_PATH = os.path.join(DATA_DIR, 'paramcodes.csv')
+LIMITS_PATH = os.path.join(DATA_DIR, 'limits.csv')
+# tracemalloc gives the peak allocation of every step but slows python heavy steps down, see --no-tracemalloc
+TRACE = True
+
+
+def measure(fn, *args, **kwargs):
+    # wall time, peak of the memory allocated during the call and the process RSS after it
+    if TRACE and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = fn(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - current if TRACE else 0
+    return result, {'seconds': round(seconds, 4), 'peak_mb': round(peak / 2**20, 2), 'rss_mb': round(psutil.Process().memory_info().rss / 2**20, 2)}
+
+
+def metric_calls(year_list: list, country_list: list):
+    # every DataAggregator metric with each product and programme it takes
+    calls = [('country_year_pesticide_count', dict(year_list=year_list, country_list=country_list, paramcodes_path=PARAMCODES_PATH))]
+    for product in ['milk', 'butter', 'both']:
+        base = dict(year_list=year_list, country_list=country_list, product=product)
+        calls += [
+            ('count_samples_without_limits', base),
+            ('country_year_pesticide_list', dict(base, paramcodes_path=PARAMCODES_PATH)),
+            ('country_year_pesticide_origin_list', dict(base, paramcodes_path=PARAMCODES_PATH)),
+            ('percentage_with_pesticides', base),
+            ('percentage_with_number_pesticides', base),
+            ('percentage_with_pesticides_limits', dict(base, limits_path=PARAMCODES_PATH, sample_id=True)),
+            ('count_detected_pesticides', base),
+            ('yearly_top_pesticides', base),
+            ('number_of_pesticides', dict(year_list=year_list, product=product)),
+        ]
+        for programme in ['obligatory', 'voluntary', 'both']:
+            calls += [
+                ('country_pesticides', dict(base, paramcodes_path=PARAMCODES_PATH, programme=programme)),
+                ('pesticides_sampling_relation', dict(base, programme=programme)),
+                ('country_pesticide_relation', dict(base, paramcodes_path=PARAMCODES_PATH, programme=programme)),
+            ]
+    for product in ['milk', 'butter']:
+        base = dict(year_list=year_list, country_list=country_list, product=product)
+        calls += [
+            ('count_samples', dict(base, limits_dir=LIMITS_PATH)),
+            ('count_obligatory_voluntary_samples', base),
+        ]
+        for programme in ['obligatory', 'voluntary', 'both']:
+            calls.append(('country_year_pesticide_list_obligatory', dict(base, paramcodes_path=PARAMCODES_PATH, programme=programme)))
+        for country_type in ['origin', 'reporting']:
+            calls += [
+                ('voluntary_programmes_ranking', dict(base, country_type=country_type)),
+                ('voluntary_sampling_stats', dict(base, country_type=country_type, limits_path=PARAMCODES_PATH)),
+            ]
+    return calls
+
+
+def describe(kwargs: dict):
+    # the arguments that tell calls apart, lists only by their length
+    return {key: len(value) if isinstance(value, list) else value for key, value in kwargs.items() if not key.endswith(('_path', '_dir'))}
+
+
+def run(work_dir: str, rows: int, noise_ratio: float, n_jobs: int, chunksize: int, compact: bool, seed: int, prefilter: bool = False):
+    raw_dir, cleaned_dir, merged_dir, store_dir = [os.path.join(work_dir, name) for name in ['raw', 'cleaned', 'merged', 'store']]
+    for path in [cleaned_dir, merged_dir]:
+        os.makedirs(path, exist_ok=True)
+    results = []
+
+    written, stats = measure(generate, raw_dir, rows, noise_ratio, seed=seed)
+    results.append({'stage': 'generate', 'name': 'generate', 'params': {'rows': rows}, 'rows_out': sum(written.values()), **stats})
+    country_list = sorted({country for country, _ in written})
+    year_list = sorted({year for _, year in written})
+    exceptions_list = exceptions(written, country_list, year_list)
+
+    # DataLoader, one load per raw file and the steps after it
+    loader = DataLoader(raw_dir, chunksize=chunksize, compact=compact, prefilter=prefilter)
+    for (country, year), raw_rows in sorted(written.items()):
+        _, stats = measure(loader._load_dataset, country, year, cleaned_dir)
+        rows_out = len(pd.read_pickle(os.path.join(cleaned_dir, f'cleaned_{year}_{country}.pkl')))
+        results.append({'stage': 'loader', 'name': 'load_dataset', 'params': {'country': country, 'year': year}, 'rows_in': raw_rows, 'rows_out': rows_out, **stats})
+    if n_jobs > 1:
+        _, stats = measure(loader.load_all_datasets, country_list, year_list, exceptions_list, cleaned_dir, n_jobs=n_jobs)
+        results.append({'stage': 'loader', 'name': 'load_all_datasets', 'params': {'n_jobs': n_jobs}, 'rows_in': sum(written.values()), **stats})
+    _, stats = measure(loader.concat_datasets, country_list, year_list, cleaned_dir, exceptions_list, merged_dir)
+    final_df = pd.read_pickle(os.path.join(merged_dir, 'final_dataset.pkl'))
+    results.append({'stage': 'loader', 'name': 'concat_datasets', 'params': {}, 'rows_out': len(final_df), **stats})
+    _, stats = measure(loader.write_store, country_list, year_list, cleaned_dir, exceptions_list, store_dir)
+    results.append({'stage': 'loader', 'name': 'write_store', 'params': {}, 'rows_in': len(final_df), **stats})
+
+    # same split as milk_3.pkl / butter_3.pkl
+    products = product_of(final_df)
+    final_df[products == 'milk'].to_pickle(os.path.join(merged_dir, 'milk.pkl'))
+    final_df[products == 'butter'].to_pickle(os.path.join(merged_dir, 'butter.pkl'))
+    del final_df, products
+
+    aggregator, stats = measure(DataAggregator, *[os.path.join(merged_dir, name) for name in ['final_dataset.pkl', 'milk.pkl', 'butter.pkl']], compact=compact)
+    results.append({'stage': 'aggregator', 'name': '__init__', 'params': {'compact': compact}, **stats})
+    for name, kwargs in metric_calls(year_list, country_list):
+        res, stats = measure(getattr(aggregator, name), **kwargs)
+        results.append({'stage': 'aggregator', 'name': name, 'params': describe(kwargs), 'rows_out': len(res) if isinstance(res, pd.DataFrame) else None, **stats})
+    return results
+
+
+def compare(old_path: str, new_path: str):
+    def load(path):
+        with open(path) as f:
+            return {(r['stage'], r['name'], json.dumps(r['params'], sort_keys=True)): r for r in json.load(f)['results']}
+    old, new = load(old_path), load(new_path)
+    print(f'{"step":<60}{"old [s]":>10}{"new [s]":>10}{"speedup":>9}{"old peak":>10}{"new peak":>10}')
+    for key in [key for key in new if key in old]:
+        o, n = old[key], new[key]
+        label = f'{key[1]} {" ".join(f"{v}" for v in json.loads(key[2]).values())}'[:58]
+        print(f'{label:<60}{o["seconds"]:>10.3f}{n["seconds"]:>10.3f}{o["seconds"] / max(n["seconds"], 1e-6):>8.1f}x{o["peak_mb"]:>10.1f}{n["peak_mb"]:>10.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and memory profile of every DataLoader step and DataAggregator metric on synthetic data.')
+    parser.add_argument('--rows', type=float, default=1e6, help='raw rows over all files, 1e5 to 1e8')
+    parser.add_argument('--noise-ratio', type=float, default=3.0)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--chunksize', type=int, default=None)
+    parser.add_argument('--compact', action='store_true')
+    parser.add_argument('--prefilter', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-tracemalloc', action='store_true', help='only time and RSS, peak_mb is 0')
+    parser.add_argument('--work-dir', default=None, help='keeps the generated data, a temporary directory otherwise')
+    parser.add_argument('--output', default=None, help='json file for the results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+
+    TRACE = not args.no_tracemalloc
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = run(args.work_dir or tmp_dir, int(args.rows), args.noise_ratio, args.jobs, args.chunksize, args.compact, args.seed, args.prefilter)
+
+    meta = {'rows': int(args.rows), 'noise_ratio': args.noise_ratio, 'jobs': args.jobs, 'chunksize': args.chunksize, 'compact': args.compact, 'prefilter': args.prefilter,
+            'seed': args.seed, 'tracemalloc': TRACE, 'python': platform.python_version(), 'pandas': pd.__version__, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    output = args.output or f'bench_{time.strftime("%Y%m%d_%H%M%S")}.json'
+    with open(output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+
+    for stage in ['generate', 'loader', 'aggregator']:
+        seconds = sum(r['seconds'] for r in results if r['stage'] == stage)
+        peak = max(r['peak_mb'] for r in results if r['stage'] == stage)
+        print(f'{stage:<12}{seconds:>10.2f}s  peak {peak:.1f} MB')
+    print(f'Results saved to {output}.')
@@ -0,0 +1,143 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+import pandas as pd
+
+from src.aggregator import DataAggregator
+from src.paramcodes import get_registry
+from src.topk import grouped_top_k
+from src.visualization import chord_matrix, stats_labels
+
+PARAMCODES_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'paramcodes.csv')
+
+
+class RowwiseAggregator(DataAggregator):
+    # the percentage step as it was written before, one Series lookup per row
+    def _percentage(self, counts, keys, totals):
+        rows = pd.DataFrame({'count': counts.to_numpy(), **{f'key{i}': key.to_numpy() for i, key in enumerate(keys)}})
+        if len(keys) > 1:
+            return rows.apply(lambda row: (row['count'] / totals[tuple(row[f'key{i}'] for i in range(len(keys)))]) * 100, axis=1).to_numpy()
+        return rows.apply(lambda row: (row['count'] / totals[row['key0']]) * 100, axis=1).to_numpy()
+
+
+def rowwise_chord_matrix(agg, country, node_index):
+    matrix = [[0] * len(node_index) for _ in range(len(node_index))]
+    for _, row in agg.iterrows():
+        i = node_index[row[country]]
+        j = node_index[row["name"]]
+        matrix[i][j] = row["Number of samples with pesticide"]
+        matrix[j][i] = row["Number of samples with pesticide"]
+    return matrix
+
+
+def sorted_top_k(df, by, value, k):
+    # the top-k step as it was written before, every group fully sorted
+    return df.sort_values(by + [value], ascending=[True] * len(by) + [False]).groupby(by).head(k)
+
+
+def rowwise_stats_labels(df):
+    return df.apply(lambda x: f"L={int(x['limit_samples'])} \nV={int(x['VAL_samples'])} \n∑={int(x['total_samples'])}", axis=1)
+
+
+def make_residues(n_countries, n_years, n_pesticides, n_samples, seed=0):
+    rng = np.random.default_rng(seed)
+    codes = get_registry(PARAMCODES_PATH).codes[:n_pesticides].to_numpy(dtype=object)
+    countries = np.array([f'C{i:02d}' for i in range(n_countries)], dtype=object)
+    years = np.arange(2011, 2011 + n_years)
+
+    country = np.repeat(countries, n_years * n_samples * len(codes))
+    year = np.tile(np.repeat(years, n_samples * len(codes)), n_countries)
+    sample = np.repeat(np.arange(n_countries * n_years * n_samples), len(codes))
+    res_val = np.where(rng.random(len(sample)) < 0.02, rng.random(len(sample)).round(3), np.nan)
+    return pd.DataFrame({
+        'sampleId': pd.Series(sample).map('S{:08d}'.format).to_numpy(dtype=object),
+        'sampCountry': country,
+        'origCountry': country,
+        'productCode': 'A02LX',
+        'progType': rng.choice(['K005A', 'K009A', 'K018A'], len(sample)),
+        'pesticideCode': np.tile(codes, n_countries * n_years * n_samples),
+        'resVal': res_val,
+        'resType': np.where(np.isnan(res_val), 'LOQ', 'VAL'),
+        'year': year,
+    })
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def assert_same(a, b):
+    if isinstance(a, pd.DataFrame):
+        pd.testing.assert_frame_equal(a, b)
+    else:
+        np.testing.assert_array_equal(np.asarray(a), np.asarray(b))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Row-wise vs vectorized percentage, label and matrix computations.')
+    parser.add_argument('--countries', type=int, default=35)
+    parser.add_argument('--years', type=int, default=13)
+    parser.add_argument('--pesticides', type=int, default=100)
+    parser.add_argument('--samples', type=int, default=30)
+    args = parser.parse_args()
+
+    df = make_residues(args.countries, args.years, args.pesticides, args.samples)
+    country_list = df['sampCountry'].unique().tolist()
+    year_list = df['year'].unique().tolist()
+    print(f'{len(df)} residue rows, {len(country_list)} countries x {len(year_list)} years x {args.pesticides} pesticides')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        df.to_pickle(os.path.join(tmp_dir, 'final_dataset.pkl'))
+        df.to_pickle(os.path.join(tmp_dir, 'milk.pkl'))
+        df.iloc[:0].to_pickle(os.path.join(tmp_dir, 'butter.pkl'))
+        paths = [os.path.join(tmp_dir, name) for name in ['final_dataset.pkl', 'milk.pkl', 'butter.pkl']]
+        vectorized, rowwise = DataAggregator(*paths), RowwiseAggregator(*paths)
+        indexed = DataAggregator(*paths, pesticide_index=True)
+
+    relation = vectorized.country_year_pesticide_list(year_list, country_list, PARAMCODES_PATH, product='milk', top_k=args.pesticides)
+    agg = relation.groupby(['sampCountry', 'name'])['Number of samples with pesticide'].sum().reset_index()
+    nodes = agg['sampCountry'].unique().tolist() + agg['name'].unique().tolist()
+    node_index = {name: i for i, name in enumerate(nodes)}
+    stats = vectorized.voluntary_sampling_stats(year_list, country_list, 'milk', 'reporting', PARAMCODES_PATH)
+
+    counts = df.groupby(['sampCountry', 'year', 'pesticideCode'])['sampleId'].count().reset_index(name='sample_count')
+    totals = df.groupby(['sampCountry', 'year'])['sampleId'].nunique()
+    keys = [counts['sampCountry'], counts['year']]
+
+    cases = [
+        ('percentage step', lambda: rowwise._percentage(counts['sample_count'], keys, totals), lambda: vectorized._percentage(counts['sample_count'], keys, totals)),
+        ('country_year_pesticide_count',
+         lambda: rowwise.country_year_pesticide_count(year_list, country_list, PARAMCODES_PATH),
+         lambda: vectorized.country_year_pesticide_count(year_list, country_list, PARAMCODES_PATH)),
+        ('country_pesticide_relation',
+         lambda: rowwise.country_pesticide_relation(year_list, country_list, 'milk', PARAMCODES_PATH, top_k=args.pesticides),
+         lambda: vectorized.country_pesticide_relation(year_list, country_list, 'milk', PARAMCODES_PATH, top_k=args.pesticides)),
+        ('plot_chord matrix', lambda: rowwise_chord_matrix(agg, 'sampCountry', node_index), lambda: chord_matrix(agg, 'sampCountry', node_index)),
+        ('grouped top-k', lambda: sorted_top_k(counts, ['sampCountry', 'year'], 'sample_count', 5), lambda: grouped_top_k(counts, ['sampCountry', 'year'], 'sample_count', 5)),
+        ('plot_stats_heatmap labels', lambda: rowwise_stats_labels(stats), lambda: stats_labels(stats)),
+    ]
+
+    print(f'{"step":<30}{"row-wise [s]":>14}{"vectorized [s]":>16}{"speedup":>10}')
+    for name, old, new in cases:
+        expected, old_time = timed(old)
+        result, new_time = timed(new)
+        assert_same(expected, result)
+        print(f'{name:<30}{old_time:>14.4f}{new_time:>16.4f}{old_time / new_time:>9.1f}x')
+
+    # the pesticide index gives the frames of the pandas path, also when no year or country of the filter is in the data
+    for filters in [(year_list, country_list), ([1990], country_list), ([], country_list), (year_list, ['XX'])]:
+        for product in ['milk', 'butter', 'both']:
+            expected = vectorized.percentage_with_number_pesticides(*filters, product)
+            result = indexed.percentage_with_number_pesticides(*filters, product)
+            assert list(expected.columns) == list(result.columns) and len(expected) == len(result)
+            if len(expected):
+                pd.testing.assert_frame_equal(expected.reset_index(drop=True), result.reset_index(drop=True), check_dtype=False)
+    print('pesticide index matches the pandas path')
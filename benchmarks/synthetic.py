@@ -0,0 +1,133 @@
+import argparse
+import glob
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+import pandas as pd
+
+from src.data_loader import NEW_COLUMNS, OLD_COLUMNS
+
+CLEANED_DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'cleaned')
+
+# cleaned column -> raw column, the inverse of DataLoader._clean_new / _clean_old
+NEW_RAW = {'sampleId': 'sampId_A', 'productCode': 'sampMatCode.base.building', 'pesticideCode': 'paramCode.base.param'}
+OLD_RAW = {'sampleId': 'LABSAMPCODE_A', 'sampCountry': 'SAMPCOUNTRY', 'origCountry': 'ORIGCOUNTRY', 'productCode': 'PRODCODE',
+           'efsaProductCode': 'EFSAPRODCODE', 'productTreat': 'PRODTREAT', 'progType': 'PROGTYPE', 'pesticideCode': 'PARAMCODE',
+           'resVal': 'RESVAL', 'fatPerc': 'FATPERC', 'resType': 'RESTYPE'}
+# product codes of other foods, the loader drops these rows like the non-dairy rows of the real files
+NOISE_PRODUCTS = {'new': ['A0DVX', 'A01DJ', 'A0DQS'], 'old': ['P0110010A', 'P0211000A', 'P0401050A']}
+
+
+class SampleProfile:
+    # the samples of one cleaned file, new samples are drawn from them whole, so detection rates,
+    # pesticides per sample, results and programme/product mix follow the real data
+    def __init__(self, df: pd.DataFrame):
+        codes, _ = pd.factorize(df['sampleId'])
+        order = np.argsort(codes, kind='stable')
+        self.rows = df.iloc[order].reset_index(drop=True)
+        self.sizes = np.bincount(codes)
+        self.starts = np.concatenate([[0], np.cumsum(self.sizes)[:-1]])
+
+    def draw(self, rng: np.random.Generator, n_rows: int):
+        # whole samples while they fit into n_rows residue rows, at least one
+        picks = rng.integers(0, len(self.sizes), int(n_rows / self.sizes.mean() * 1.2) + 10)
+        while self.sizes[picks].sum() < n_rows:
+            picks = np.concatenate([picks, rng.integers(0, len(self.sizes), len(picks))])
+        lengths = self.sizes[picks]
+        picks = picks[:max(1, np.searchsorted(np.cumsum(lengths), n_rows, side='right'))]
+        lengths = self.sizes[picks]
+        offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        row_idx = np.arange(lengths.sum()) - offsets + np.repeat(self.starts[picks], lengths)
+        return self.rows.iloc[row_idx].reset_index(drop=True), lengths
+
+
+def cleaned_shares(cleaned_dir: str = CLEANED_DIR):
+    # rows per (country, year) of the cleaned files, the synthetic files keep these proportions
+    sizes = {}
+    for path in sorted(glob.glob(os.path.join(cleaned_dir, 'cleaned_*_*.pkl'))):
+        year, country = os.path.basename(path)[len('cleaned_'):-len('.pkl')].split('_')
+        sizes[(country, int(year))] = len(pd.read_pickle(path))
+    total = sum(sizes.values())
+    return {key: size / total for key, size in sizes.items()}
+
+
+def generate(dest_dir: str, rows: int, noise_ratio: float = 3.0, extra_columns: int = 20, country_list: list = None,
+             year_list: list = None, chunk_rows: int = 10**6, cleaned_dir: str = CLEANED_DIR, seed: int = 0):
+    # rows counts every raw row, noise_ratio non-dairy rows are written for each dairy row
+    os.makedirs(dest_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    shares = {key: share for key, share in cleaned_shares(cleaned_dir).items()
+              if share > 0 and (country_list is None or key[0] in country_list) and (year_list is None or key[1] in year_list)}
+    total_share = sum(shares.values())
+    dairy_rows = rows / (1 + noise_ratio)
+
+    written = {}
+    sample_counter = 0
+    for file_no, ((country, year), share) in enumerate(sorted(shares.items(), key=lambda item: (item[0][1], item[0][0]))):
+        target = max(1, round(dairy_rows * share / total_share))
+        layout = 'old' if year <= 2018 else 'new'
+        profile = SampleProfile(pd.read_pickle(os.path.join(cleaned_dir, f'cleaned_{year}_{country}.pkl')))
+        path = os.path.join(dest_dir, f'MOPER_ALL_DATA_{year}_{country}.csv' if layout == 'old' else f'MOPER_ALL_DATA_SSD2_{year}_{country}.csv')
+
+        n_rows = 0
+        remaining = target
+        header = True
+        while remaining > 0:
+            n_draw = min(remaining, chunk_rows)
+            chunk, lengths = profile.draw(rng, n_draw)
+            # fresh 32 character hex ids like the hashed ids of the real files, unique across all files,
+            # the leading F keeps ids such as 0000E200... from being read as numbers
+            ids = pd.Series(np.arange(sample_counter, sample_counter + len(lengths))).map(f'F{file_no:07X}{{:024X}}'.format)
+            chunk['sampleId'] = np.repeat(ids.to_numpy(dtype=object), lengths)
+            sample_counter += len(lengths)
+            raw = to_raw(chunk, layout, rng, noise_ratio, extra_columns)
+            raw.to_csv(path, mode='w' if header else 'a', header=header, index=False)
+            header = False
+            n_rows += len(raw)
+            remaining -= len(chunk)
+            if n_draw == remaining + len(chunk) and len(chunk) < n_draw:
+                # the next sample would not fit any more
+                break
+        written[(country, year)] = n_rows
+    return written
+
+
+def to_raw(df: pd.DataFrame, layout: str, rng: np.random.Generator, noise_ratio: float, extra_columns: int):
+    if layout == 'new':
+        raw = df.rename(columns=NEW_RAW)[NEW_COLUMNS]
+        product_col = 'sampMatCode.base.building'
+    else:
+        raw = df.rename(columns=OLD_RAW)[OLD_COLUMNS]
+        product_col = 'PRODCODE'
+    n_noise = int(len(raw) * noise_ratio)
+    if n_noise:
+        noise = raw.iloc[rng.integers(0, len(raw), n_noise)].copy()
+        noise[product_col] = rng.choice(NOISE_PRODUCTS[layout], n_noise)
+        raw = pd.concat([raw, noise], ignore_index=True).iloc[rng.permutation(len(raw) + n_noise)]
+    # the real files carry many more columns than the loader reads
+    for i in range(extra_columns):
+        raw[f'extraColumn{i}'] = 'N_A'
+    return raw
+
+
+def exceptions(written: dict, country_list: list, year_list: list):
+    # (country, year) pairs without a file, in the form DataLoader expects
+    return [(country, year) for country in country_list for year in year_list if (country, year) not in written]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write EFSA shaped MOPER_ALL_DATA_* csv files sampled from data/cleaned.')
+    parser.add_argument('dest_dir')
+    parser.add_argument('--rows', type=float, default=1e6, help='raw rows over all files, 1e5 to 1e8')
+    parser.add_argument('--noise-ratio', type=float, default=3.0)
+    parser.add_argument('--extra-columns', type=int, default=20)
+    parser.add_argument('--countries', nargs='*', default=None)
+    parser.add_argument('--years', nargs='*', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    written = generate(args.dest_dir, int(args.rows), args.noise_ratio, args.extra_columns, args.countries, args.years, seed=args.seed)
+    print(f'{sum(written.values())} rows in {len(written)} files written to {args.dest_dir}.')
@@ -1,39 +1,381 @@
 import pandas as pd
 import numpy as np
 
+import os
+import threading
+from functools import cached_property
+from src.bitmaps import PesticideBitmaps
+from src.cache import CACHE_SIZE_MB, ResultCache, memoized
+from src.chunked import StorePartials, row_positions
+from src.cooccurrence import co_occurrence, detection_matrix
+from src.cube import SampleCube
+from src.facts import build_facts, count_samples, pesticides_per_sample, save_facts, load_facts, source_key
+from src.instrument import traced
+from src.paramcodes import file_signature, get_registry
+from src.schema import CompactSchema, memory_report
+from src.sketch import PRECISION, SampleSketches
+from src.store import list_partitions, read_store
+from src.topk import grouped_top_k
+
+FRAMES = ['dataframe', 'milk_dataframe', 'butter_dataframe']
+# the programme subsets are boolean masks over the rows of the product frames, not copies of them
+MASKS = ['milk_obligatory_mask', 'butter_obligatory_mask', 'milk_voluntary_mask', 'butter_voluntary_mask']
+# sample fact table of every residue frame, the programme subsets are flags on the product tables
+FACTS = {'dataframe': 'facts', 'milk_dataframe': 'milk_facts', 'butter_dataframe': 'butter_facts'}
+# partial aggregates of every residue frame in chunked mode, see StorePartials
+PARTIALS = {'dataframe': 'partials', 'milk_dataframe': 'milk_partials', 'butter_dataframe': 'butter_partials'}
+OBLIGATORY_YEARS = {'dataframe': None, 'milk_dataframe': [2013, 2016, 2019, 2022], 'butter_dataframe': [2012, 2015]}
+PRODUCT_FRAME = {'both': 'dataframe', 'milk': 'milk_dataframe', 'butter': 'butter_dataframe'}
+# row predicates and measures of DataAggregator.query, the sample count measures of _samples are predicates there
+PREDICATES = [None, 'detected', 'val', 'exceeds']
+MEASURES = ['samples', 'rows']
+PREDICATE = {'samples': None, 'positive_samples': 'detected', 'val_samples': 'val'}
+
+
+class loaded_property(cached_property):
+    # cached_property under the lock of the aggregator, a frame first read by several threads at once
+    # (the report jobs) is built once, functools.cached_property has no lock of its own since python 3.12
+    def __get__(self, instance, owner=None):
+        if instance is None or self.attrname in instance.__dict__:
+            return super().__get__(instance, owner)
+        with instance._load_lock:
+            return super().__get__(instance, owner)
+
+
+def _filter_key(product, programme, year_list, country_list, country, facts):
+    # the filters of a query, the lists as sets since only their values count
+    return (product, programme, None if year_list is None else frozenset(year_list),
+            None if country_list is None else frozenset(country_list), country, facts)
+
+
+def _input_rows(arguments: dict):
+    # rows of the product frame a traced metric read, the fact table in sample facts mode
+    self = arguments['self']
+    frame = PRODUCT_FRAME.get(arguments.get('product', 'both'), 'dataframe')
+    table = self.__dict__.get(FACTS[frame]) if self.sample_facts else None
+    if table is None:
+        table = self.__dict__.get(frame)
+    return None if table is None else len(table)
+
+
 class DataAggregator:
-    def __init__(self, data_dir: str, milk_dir: str, butter_dir: str):
+    def __init__(self, data_dir: str = None, milk_dir: str = None, butter_dir: str = None, store_dir: str = None, year_list: list = None, country_list: list = None, programme_list: list = None, compact: bool = False, lazy: bool = False, sample_facts: bool = False, facts_dir: str = None, use_cube: bool = False, chunked: bool = False, backend: str = 'pandas', approximate: bool = False, sketch_precision: int = PRECISION, pesticide_index: bool = False, cache_dir: str = None, cache_size_mb: float = CACHE_SIZE_MB, obligatory_years: dict = None):
         self.data_dir = data_dir
-        self.dataframe = pd.read_pickle(data_dir)
-        self.milk_dataframe = pd.read_pickle(milk_dir)
-        self.butter_dataframe = pd.read_pickle(butter_dir)  
-        
-        obligatory_year_list_milk = [2013, 2016, 2019, 2022]  
-        obligatory_year_list_butter = [2012, 2015]    
-        
-        self.milk_obligatory_dataframe = self.milk_dataframe[(self.milk_dataframe['year'].isin(obligatory_year_list_milk)) & self.milk_dataframe['progType'].isin(['K009A', 'K018A'])]
-        self.butter_obligatory_dataframe = self.butter_dataframe[(self.butter_dataframe['year'].isin(obligatory_year_list_butter)) & self.butter_dataframe['progType'].isin(['K009A', 'K018A'])]
-        self.milk_voluntary_dataframe = self.milk_dataframe[(~self.milk_dataframe['year'].isin(obligatory_year_list_milk)) | (self.milk_dataframe['progType'].isin(['K005A', 'K018A']))]
-        self.butter_voluntary_dataframe = self.butter_dataframe[(~self.butter_dataframe['year'].isin(obligatory_year_list_butter)) | (self.butter_dataframe['progType'].isin(['K005A', 'K018A']))]
+        self.milk_dir = milk_dir
+        self.butter_dir = butter_dir
+        self.store_dir = store_dir
+        # only the partitions matching these filters are read from the store
+        self.store_filters = {'year_list': year_list, 'country_list': country_list, 'programme_list': programme_list}
+        
+        # years of the obligatory programme per product, {'milk': [...], 'butter': [...]} replaces the lists of OBLIGATORY_YEARS,
+        # e.g. when a new reporting year is an obligatory one
+        self.obligatory_years = dict(OBLIGATORY_YEARS)
+        for product, years in (obligatory_years or {}).items():
+            self.obligatory_years[PRODUCT_FRAME[product]] = sorted(years)
+        
+        # category dtypes with one dictionary shared by all frames, interned sample ids and float32 results where that is exact
+        self.schema = CompactSchema() if compact else None
+        
+        # count metrics read one row per sample instead of the residue rows, facts_dir keeps the tables between sessions
+        self.sample_facts = sample_facts
+        self.facts_dir = facts_dir
+        # sample counts come from a cube rolled up from the fact tables, stored in facts_dir as well
+        self.use_cube = use_cube
+        # approximate mode estimates sample counts from HyperLogLog sketches, see src/sketch.py for the error bound,
+        # set approximate back to False for exact counts, the sketches are kept in facts_dir as well
+        self.approximate = approximate
+        self.sketch_precision = sketch_precision
+        # the multi-residue metrics (2.3, 6) read a per-pesticide bitmap index of the samples instead of the residue rows,
+        # see samples_with_pesticides for queries on it, the index is kept in facts_dir as well
+        self.pesticide_index = pesticide_index
+        
+        # chunked mode streams the store one partition file at a time and keeps what the metrics need of it:
+        # the sample facts, the residue rows with a result and the residue rows per pesticide,
+        # so the frames hold the detected rows only and every sample count comes from the facts.
+        # memory is O(samples + detections) instead of O(residue rows), not bounded: 2.4 returns detection rows
+        # and the per-pesticide distinct counts (2.2, 2.5, 7, 9) need the detections of every sample.
+        # with facts_dir the partial aggregates of every partition file are kept there, after a new year is
+        # added to the store only its files are read (see DataLoader.write_store with a manifest)
+        if chunked and store_dir is None:
+            raise ValueError('Chunked mode reads the partitioned store, store_dir is required.')
+        self.chunked = chunked
+        self.sample_facts = sample_facts or chunked
+        
+        # backend='duckdb' runs the per-pesticide cross-tabs (2.2, 2.5, 7) as sql on the store or the frames
+        self.sql = None
+        if backend == 'duckdb':
+            from src.sql import SqlBackend
+            self.sql = SqlBackend(self, self.obligatory_years)
+        elif backend != 'pandas':
+            raise ValueError(f'Unknown backend {backend}, use pandas or duckdb.')
+        
+        # masks of the filters passed to share, built on first use and read by every query with the same filters
+        self.shared = {}
+        self._load_lock = threading.RLock()
+        
+        # results of the metrics are kept in cache_dir, keyed by the arguments and the input files, see cache_report
+        self.cache = ResultCache(cache_dir, cache_size_mb) if cache_dir is not None else None
+        
+        # in lazy mode every frame is read or built on first access, see load and release
+        if not lazy:
+            self.load()
+    
+    def load(self, *frames):
+        for name in frames or self._frame_names():
+            getattr(self, name)
+    
+    def release(self, *frames):
+        if not frames:
+            self.unshare()
+        for name in frames or FRAMES + MASKS + list(FACTS.values()) + list(PARTIALS.values()) + ['cube', 'sketches', 'bitmaps']:
+            self.__dict__.pop(name, None)
+    
+    def share(self, product: str = 'both', programme: str = 'all', year_list: list = None, country_list: list = None, country: str = 'sampCountry'):
+        # the mask of the rows of product and programme in these years and countries is built once, on first use, and every
+        # query and _rows with the same filters reads it until unshare, e.g. the report jobs of one group
+        for facts in dict.fromkeys([False, self.sample_facts]):
+            self.shared.setdefault(_filter_key(product, programme, year_list, country_list, country, facts), None)
+    
+    def unshare(self):
+        self.shared.clear()
+    
+    @loaded_property
+    def dataframe(self):
+        return self._read_frame(self.data_dir, 'both')
+    
+    @loaded_property
+    def milk_dataframe(self):
+        return self._read_frame(self.milk_dir, 'milk')
+    
+    @loaded_property
+    def butter_dataframe(self):
+        return self._read_frame(self.butter_dir, 'butter')
+    
+    @loaded_property
+    def milk_obligatory_mask(self):
+        return self._programme_mask('milk_dataframe', 'obligatory')
+    
+    @loaded_property
+    def butter_obligatory_mask(self):
+        return self._programme_mask('butter_dataframe', 'obligatory')
+    
+    @loaded_property
+    def milk_voluntary_mask(self):
+        return self._programme_mask('milk_dataframe', 'voluntary')
+    
+    @loaded_property
+    def butter_voluntary_mask(self):
+        return self._programme_mask('butter_dataframe', 'voluntary')
+    
+    # the rows of a programme, taken from the product frame on every access, the metrics only use the masks
+    @property
+    def milk_obligatory_dataframe(self):
+        return self._rows('milk_obligatory_dataframe')
+    
+    @property
+    def butter_obligatory_dataframe(self):
+        return self._rows('butter_obligatory_dataframe')
+    
+    @property
+    def milk_voluntary_dataframe(self):
+        return self._rows('milk_voluntary_dataframe')
+    
+    @property
+    def butter_voluntary_dataframe(self):
+        return self._rows('butter_voluntary_dataframe')
+    
+    @loaded_property
+    def facts(self):
+        return self._read_facts('dataframe')
+    
+    @loaded_property
+    def milk_facts(self):
+        return self._read_facts('milk_dataframe')
+    
+    @loaded_property
+    def butter_facts(self):
+        return self._read_facts('butter_dataframe')
+    
+    @loaded_property
+    def partials(self):
+        return self._scan('dataframe')
+    
+    @loaded_property
+    def milk_partials(self):
+        return self._scan('milk_dataframe')
+    
+    @loaded_property
+    def butter_partials(self):
+        return self._scan('butter_dataframe')
+    
+    @loaded_property
+    def cube(self):
+        path = None
+        if self.facts_dir is not None:
+            path = os.path.join(self.facts_dir, f'cube-{source_key(*[self._source_key(frame) for frame in FACTS])}.pkl')
+            if os.path.exists(path):
+                return SampleCube.load(path)
+        cube = SampleCube.build({'both': self.facts, 'milk': self.milk_facts, 'butter': self.butter_facts})
+        if path is not None:
+            os.makedirs(self.facts_dir, exist_ok=True)
+            cube.save(path)
+        return cube
+    
+    @loaded_property
+    def sketches(self):
+        path = None
+        if self.facts_dir is not None:
+            key = source_key(*[self._source_key(frame) for frame in FACTS], self.sketch_precision)
+            path = os.path.join(self.facts_dir, f'sketches-{key}.pkl')
+            if os.path.exists(path):
+                return SampleSketches.load(path)
+        sketches = SampleSketches.build({'both': self.facts, 'milk': self.milk_facts, 'butter': self.butter_facts},
+                                        {'both': self.dataframe, 'milk': self.milk_dataframe, 'butter': self.butter_dataframe},
+                                        {'milk': self.obligatory_years['milk_dataframe'], 'butter': self.obligatory_years['butter_dataframe']},
+                                        self.sketch_precision)
+        if path is not None:
+            os.makedirs(self.facts_dir, exist_ok=True)
+            sketches.save(path)
+        return sketches
+    
+    @loaded_property
+    def bitmaps(self):
+        path = None
+        if self.facts_dir is not None:
+            path = os.path.join(self.facts_dir, f'bitmaps-{source_key(*[self._source_key(frame) for frame in FACTS])}.pkl')
+            if os.path.exists(path):
+                return PesticideBitmaps.load(path)
+        bitmaps = PesticideBitmaps.build({'both': self.facts, 'milk': self.milk_facts, 'butter': self.butter_facts},
+                                         {'both': self.dataframe, 'milk': self.milk_dataframe, 'butter': self.butter_dataframe})
+        if path is not None:
+            os.makedirs(self.facts_dir, exist_ok=True)
+            bitmaps.save(path)
+        return bitmaps
+    
+    @traced('aggregator')
+    def _read_frame(self, path: str, product: str):
+        if self.chunked:
+            df = getattr(self, PARTIALS[PRODUCT_FRAME[product]]).detections
+        elif self.store_dir is not None:
+            df = read_store(self.store_dir, product=product, **self.store_filters)
+        else:
+            df = pd.read_pickle(path)
+        if self.schema is not None:
+            df = self.schema.fit(df).compact(df)
+        return df
+    
+    @traced('aggregator')
+    def _read_facts(self, frame: str):
+        path = None
+        if self.facts_dir is not None:
+            path = os.path.join(self.facts_dir, f'{FACTS[frame]}-{self._source_key(frame)}.parquet')
+            if os.path.exists(path):
+                return load_facts(path)
+        if self.chunked:
+            facts = getattr(self, PARTIALS[frame]).facts
+        else:
+            facts = build_facts(getattr(self, frame), self.obligatory_years[frame])
+        if path is not None:
+            os.makedirs(self.facts_dir, exist_ok=True)
+            save_facts(facts, path)
+        return facts
+    
+    def _source_key(self, frame: str):
+        product = {'dataframe': 'both', 'milk_dataframe': 'milk', 'butter_dataframe': 'butter'}[frame]
+        if self.store_dir is not None:
+            files = list_partitions(self.store_dir, product, self.store_filters['year_list'], self.store_filters['country_list'])
+            source = [(f, file_signature(f)) for f in files] + [self.store_filters]
+        else:
+            path = {'dataframe': self.data_dir, 'milk_dataframe': self.milk_dir, 'butter_dataframe': self.butter_dir}[frame]
+            source = [os.path.abspath(path), file_signature(path)]
+        return source_key(source, self.obligatory_years[frame], self.schema is not None, self.chunked)
+    
+    def _dataset_key(self):
+        # the input of every product frame and the settings that change results, part of every result cache key
+        paths = {'dataframe': self.data_dir, 'milk_dataframe': self.milk_dir, 'butter_dataframe': self.butter_dir}
+        frames = [frame for frame in FACTS if self.store_dir is not None or paths[frame] is not None]
+        return [self._source_key(frame) for frame in frames], self.approximate, self.approximate and self.sketch_precision
+    
+    @traced('aggregator')
+    def _scan(self, frame: str):
+        product = {'dataframe': 'both', 'milk_dataframe': 'milk', 'butter_dataframe': 'butter'}[frame]
+        partials_dir = os.path.join(self.facts_dir, 'partials') if self.facts_dir is not None else None
+        return StorePartials.scan(self.store_dir, product, obligatory_year_list=self.obligatory_years[frame], partials_dir=partials_dir, **self.store_filters)
+    
+    def _programme_mask(self, frame: str, programme: str):
+        df = getattr(self, frame)
+        obligatory_years = df['year'].isin(self.obligatory_years[frame])
+        if programme == 'obligatory':
+            return (obligatory_years & df['progType'].isin(['K009A', 'K018A'])).to_numpy()
+        return (~obligatory_years | df['progType'].isin(['K005A', 'K018A'])).to_numpy()
+    
+    def _table(self, name: str):
+        # the rows of the frame called name, or of its sample fact table when counting from facts
+        return self._rows(name, facts=self.sample_facts)
+    
+    def _rows(self, name: str, year_list: list = None, country_list: list = None, country: str = 'sampCountry', measure: str = 'rows', facts: bool = False):
+        # rows of the frame called name in these years and countries, positive_samples / val_samples keep the rows with a detection / a VAL result.
+        # the programme mask and the filters are combined into one mask over the product frame (or fact table) and the rows are taken once
+        product, programme = self._cell(name)
+        df, mask = self._filtered(product, programme, year_list, country_list, country, PREDICATE.get(measure), facts)
+        return df if mask is None else df[mask]
+    
+    def _filtered(self, product, programme, year_list, country_list, country, predicate, facts):
+        # the frame (or fact table) to read and the mask of the rows passing the filters and the predicate,
+        # the mask of shared filters is built once and only the predicate is left to apply
+        df = self._source(product, facts)
+        key = _filter_key(product, programme, year_list, country_list, country, facts)
+        if key not in self.shared:
+            return df, self._mask(df, product, programme, year_list, country_list, country, predicate, facts)
+        if self.shared[key] is None:
+            with self._load_lock:
+                if self.shared[key] is None:
+                    mask = self._mask(df, product, programme, year_list, country_list, country, None, facts)
+                    self.shared[key] = np.ones(len(df), dtype=bool) if mask is None else mask
+        mask = self._mask(df, product, 'all', None, None, country, predicate, facts)
+        return df, self.shared[key] if mask is None else self.shared[key] & mask
+    
+    def _source(self, product: str, facts: bool):
+        frame = PRODUCT_FRAME[product]
+        return getattr(self, FACTS[frame]) if facts else getattr(self, frame)
+    
+    def _mask(self, df, product, programme, year_list, country_list, country, predicate, facts):
+        # every filter of a query as one boolean mask over df, None when nothing is filtered
+        masks = []
+        if programme != 'all':
+            masks.append(df[programme].to_numpy() if facts else getattr(self, f'{product}_{programme}_mask'))
+        if year_list is not None:
+            masks.append(df['year'].isin(year_list).to_numpy())
+        if country_list is not None:
+            masks.append(df[country].isin(country_list).to_numpy())
+        if predicate in ['detected', 'exceeds']:
+            masks.append(self._detected(df).to_numpy())
+        elif predicate == 'val':
+            masks.append(self._has_val(df).to_numpy())
+        return np.logical_and.reduce(masks) if masks else None
+    
+    def _samples(self, name: str, keys: list, year_list: list = None, country_list: list = None, country: str = 'sampCountry', measure: str = 'samples'):
+        # distinct samples per group of the frame called name, positive_samples / val_samples only count samples with a detection / a VAL result
+        return self.query(*self._cell(name), year_list, country_list, country, PREDICATE[measure], keys)
         
     # 1
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def count_samples(self, year_list: list, country_list: list, limits_dir: str, product: str = 'both'):
         limits = pd.read_csv(limits_dir)
         
         if product == 'milk':
-            df = self.milk_dataframe
+            frame = 'milk_dataframe'
             limits = limits[limits['product'] == 'milk']
             
         elif product == 'butter':
-            df = self.butter_dataframe
+            frame = 'butter_dataframe'
             limits = limits[limits['product'] == 'butter']
         else:
-            df = self.dataframe
+            frame = 'dataframe'
             
-        df = df[df['year'].isin(year_list)]
-        df = df[df['sampCountry'].isin(country_list)]
-        df = df.groupby(['sampCountry', 'year'])['sampleId'].nunique().reset_index(name='unique_sample_count')
-        df_limits = pd.merge(left=df, right=limits, how='right', left_on=['sampCountry', 'year'], right_on=['country', 'year']).fillna(0)
+        df = self._samples(frame, ['sampCountry', 'year'], year_list, country_list).reset_index(name='unique_sample_count')
+        df_limits = self._fill_zero(pd.merge(left=df, right=limits, how='right', left_on=['sampCountry', 'year'], right_on=['country', 'year']))
         df_limits['success'] = df_limits['limit'] <= df_limits['unique_sample_count']
         
         df_obligatory_voluntary = self.count_obligatory_voluntary_samples(year_list, country_list, product)
@@ -42,176 +384,154 @@ class DataAggregator:
         df_limits['voluntary_samples'] = df_limits['voluntary_samples'].fillna(0).astype(int)
         df_limits['obligatory_success'] = df_limits['limit'] <= df_limits['obligaotry_samples']
         
-        return df_limits[['country', 'year', 'limit', 'unique_sample_count', 'success', 'obligaotry_samples', 'voluntary_samples', 'obligatory_success']]
+        return self._output(df_limits[['country', 'year', 'limit', 'unique_sample_count', 'success', 'obligaotry_samples', 'voluntary_samples', 'obligatory_success']])
 
     # 2.1
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def count_samples_without_limits(self, year_list: list, country_list: list, product: str = 'both'):
         if product == 'milk':
-            df = self.milk_dataframe
+            frame = 'milk_dataframe'
         elif product == 'butter':
-            df = self.butter_dataframe
+            frame = 'butter_dataframe'
         else:
-            df = self.dataframe
-        df = df[df['year'].isin(year_list)]
-        df = df[df['sampCountry'].isin(country_list)]
-        df = df.groupby(['sampCountry', 'year'])['sampleId'].nunique().reset_index(name='unique_sample_count')
+            frame = 'dataframe'
+        df = self._samples(frame, ['sampCountry', 'year'], year_list, country_list).reset_index(name='unique_sample_count')
         all_pairs = pd.MultiIndex.from_product([country_list, year_list], names=['sampCountry', 'year'])
         df = df.set_index(['sampCountry', 'year']).reindex(all_pairs, fill_value=0).reset_index()
-        return df    
+        return self._output(df)
     
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def count_obligatory_voluntary_samples(self, year_list: list, country_list: list, product: str = 'milk', positive=False):
-        if product == 'milk':
-            df_obligatory = self.milk_obligatory_dataframe.copy()
-            df_voluntary = self.milk_voluntary_dataframe.copy()
-        elif product == 'butter':
-            df_obligatory = self.butter_obligatory_dataframe.copy()
-            df_voluntary = self.butter_voluntary_dataframe.copy()
-        else:
+        if product not in ['milk', 'butter']:
             return 0 
         
-        if positive:
-            df_obligatory = df_obligatory[~df_obligatory['resVal'].isna()]
-            df_voluntary = df_voluntary[~df_voluntary['resVal'].isna()]
-        
-        df_obligatory = df_obligatory[df_obligatory['year'].isin(year_list)]
-        df_obligatory = df_obligatory[df_obligatory['sampCountry'].isin(country_list)]
-        df_obligatory = df_obligatory.groupby(['sampCountry', 'year'])['sampleId'].nunique().reset_index(name='obligaotry_samples')
-        
-        df_voluntary = df_voluntary[df_voluntary['year'].isin(year_list)]
-        df_voluntary = df_voluntary[df_voluntary['sampCountry'].isin(country_list)]
-        df_voluntary = df_voluntary.groupby(['sampCountry', 'year'])['sampleId'].nunique().reset_index(name='voluntary_samples')
+        measure = 'positive_samples' if positive else 'samples'
+        df_obligatory = self._samples(f'{product}_obligatory_dataframe', ['sampCountry', 'year'], year_list, country_list, measure=measure).reset_index(name='obligaotry_samples')
+        df_voluntary = self._samples(f'{product}_voluntary_dataframe', ['sampCountry', 'year'], year_list, country_list, measure=measure).reset_index(name='voluntary_samples')
         
-        result = pd.merge(
+        result = self._fill_zero(pd.merge(
             df_obligatory,
             df_voluntary,
             on=['sampCountry', 'year'],
             how='outer'
-        ).fillna(0)
-        return result
+        ))
+        return self._output(result)
         
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def country_year_pesticide_count(self, year_list, country_list, paramcodes_path):
-        df = self.dataframe
-        df = df[df['year'].isin(year_list)]
-        df = df[df['sampCountry'].isin(country_list)]
-        res = df.groupby(['sampCountry', 'year', 'pesticideCode'])['sampleId'].count().reset_index(name='sample_count')
-        total_samples_per_country_year = self.dataframe[self.dataframe['sampCountry'].isin(country_list) & self.dataframe['year'].isin(year_list)].groupby(['sampCountry', 'year'])['sampleId'].nunique()
+        res = self._pesticide_rows(year_list, country_list).reset_index(name='sample_count')
+        total_samples_per_country_year = self._samples('dataframe', ['sampCountry', 'year'], year_list, country_list)
         
-        df_names = self._get_paramcodes_limits(path=paramcodes_path)
-        res = pd.merge(res, df_names, left_on='pesticideCode', right_on='code')
+        res = get_registry(paramcodes_path).join(res)
         
-        res['percentage'] = res.apply(lambda row: (row['sample_count'] / total_samples_per_country_year[(row['sampCountry'], row['year'])]) * 100, axis=1).round(2)
-        return res
+        res['percentage'] = self._percentage(res['sample_count'], [res['sampCountry'], res['year']], total_samples_per_country_year).round(2)
+        return self._output(res)
     
     # 2.2
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def country_year_pesticide_list(self, year_list, country_list, paramcodes_path, product = 'both', top_k=10):
         if product == 'milk':
-            df = self.milk_dataframe
+            frame = 'milk_dataframe'
         elif product == 'butter':
-            df = self.butter_dataframe
+            frame = 'butter_dataframe'
         else:
-            df = self.dataframe
-        df = df[df['year'].isin(year_list)]
-        df = df[df['sampCountry'].isin(country_list)]
-        df = df[~df['resVal'].isna()]
-        
-        df_names = self._get_paramcodes_limits(path=paramcodes_path)
-        df = pd.merge(df, df_names, left_on='pesticideCode', right_on='code')
-        
-        res = df.groupby(['sampCountry', 'year', 'name'])['sampleId'].nunique().reset_index(name='Number of samples with pesticide')
-        res = res.sort_values(['sampCountry', 'year', 'Number of samples with pesticide'], ascending=[True, True, False])
-        res = res.groupby(['sampCountry', 'year']).head(top_k).reset_index(drop=True)
-        return res
+            frame = 'dataframe'
+        if self.sql is not None:
+            return self._output(self.sql.pesticide_samples(frame, year_list, country_list, paramcodes_path, top_k))
+        res = self._pesticide_samples(frame, ['sampCountry', 'year'], year_list, country_list, paramcodes_path, 'sampCountry').reset_index(name='Number of samples with pesticide')
+        res = grouped_top_k(res, ['sampCountry', 'year'], 'Number of samples with pesticide', top_k).reset_index(drop=True)
+        return self._output(res)
     
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def country_year_pesticide_origin_list(self, year_list, country_list, paramcodes_path, product = 'both', top_k=10):
         if product == 'milk':
-            df = self.milk_dataframe
+            frame = 'milk_dataframe'
         elif product == 'butter':
-            df = self.butter_dataframe
+            frame = 'butter_dataframe'
         else:
-            df = self.dataframe
-        df = df[df['year'].isin(year_list)]
-        df = df[df['origCountry'].isin(country_list)]
-        df = df[~df['resVal'].isna()]
-        
-        df_names = self._get_paramcodes_limits(path=paramcodes_path)
-        df = pd.merge(df, df_names, left_on='pesticideCode', right_on='code')
-        
-        res = df.groupby(['origCountry', 'year', 'name'])['sampleId'].nunique().reset_index(name='Number of samples with pesticide')
-        res = res.sort_values(['origCountry', 'year', 'Number of samples with pesticide'], ascending=[True, True, False])
-        res = res.groupby(['origCountry', 'year']).head(top_k).reset_index(drop=True)
-        return res
+            frame = 'dataframe'
+        if self.sql is not None:
+            return self._output(self.sql.pesticide_samples(frame, year_list, country_list, paramcodes_path, top_k, country='origCountry'))
+        res = self._pesticide_samples(frame, ['origCountry', 'year'], year_list, country_list, paramcodes_path, 'origCountry').reset_index(name='Number of samples with pesticide')
+        res = grouped_top_k(res, ['origCountry', 'year'], 'Number of samples with pesticide', top_k).reset_index(drop=True)
+        return self._output(res)
     
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def country_year_pesticide_list_obligatory(self, year_list, country_list, paramcodes_path, product = 'milk', top_k = 10, programme = 'obligatory', country = 'sampCountry'):
         if product == 'milk':
             if programme == 'obligatory':
-                df = self.milk_obligatory_dataframe.copy()
+                frame = 'milk_obligatory_dataframe'
             elif programme == 'voluntary':
-                df = self.milk_voluntary_dataframe.copy()
+                frame = 'milk_voluntary_dataframe'
             else:
-                df = self.milk_dataframe
+                frame = 'milk_dataframe'
         elif product == 'butter':
             if programme == 'obligatory':
-                df = self.butter_obligatory_dataframe.copy()
+                frame = 'butter_obligatory_dataframe'
             elif programme == 'voluntary':
-                df = self.butter_voluntary_dataframe.copy()
+                frame = 'butter_voluntary_dataframe'
             else:
-                df = self.dataframe
+                frame = 'dataframe'
         else:
             return 0 
+        if self.sql is not None:
+            return self._output(self.sql.pesticide_samples(frame, year_list, country_list, paramcodes_path, top_k, country))
         
-        df = df[df['year'].isin(year_list)]
-        df = df[df[country].isin(country_list)]
-        df = df[~df['resVal'].isna()]
-        
-        df_names = self._get_paramcodes_limits(path=paramcodes_path)
-        df = pd.merge(df, df_names, left_on='pesticideCode', right_on='code')
-        
-        res = df.groupby([country, 'year', 'name'])['sampleId'].nunique().reset_index(name='Number of samples with pesticide')
-        res = res.sort_values([country, 'year', 'Number of samples with pesticide'], ascending=[True, True, False])
-        res = res.groupby([country, 'year']).head(top_k).reset_index(drop=True)
-        return res
+        res = self._pesticide_samples(frame, [country, 'year'], year_list, country_list, paramcodes_path, country).reset_index(name='Number of samples with pesticide')
+        res = grouped_top_k(res, [country, 'year'], 'Number of samples with pesticide', top_k).reset_index(drop=True)
+        return self._output(res)
     
     # 2.3.
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def percentage_with_pesticides(self, year_list, country_list, product):
         if product == 'milk':
-            df = self.milk_dataframe
+            frame = 'milk_dataframe'
         elif product == 'butter':
-            df = self.butter_dataframe
+            frame = 'butter_dataframe'
         else:
-            df = self.dataframe
-            
-        df = df[df['year'].isin(year_list)]
-        df = df[df['sampCountry'].isin(country_list)]
+            frame = 'dataframe'
         
-        res1 = df[~df['resVal'].isna()].groupby(['sampCountry', 'year'])['sampleId'].nunique()
-        res2 = df.groupby(['sampCountry', 'year'])['sampleId'].nunique()
-        val_count = df[df['resType'] == 'VAL'].groupby(['sampCountry', 'year'])['sampleId'].nunique()
+        res1 = self._samples(frame, ['sampCountry', 'year'], year_list, country_list, measure='positive_samples')
+        res2 = self._samples(frame, ['sampCountry', 'year'], year_list, country_list)
+        val_count = self._samples(frame, ['sampCountry', 'year'], year_list, country_list, measure='val_samples')
         
         res1, res2 = res1.align(res2, fill_value=0)
         percentage = (res1 / res2 * 100).round(2).reset_index(name='percentage_with_pesticides')
         val_percentage = (val_count / res2 * 100).round(2).reset_index(name='percentage_val_result')
-        percentage = percentage.merge(val_percentage, on=['sampCountry', 'year'], how='left').fillna(0)
+        percentage = self._fill_zero(percentage.merge(val_percentage, on=['sampCountry', 'year'], how='left'))
         percentage['total_samples'] = res2.values
 
-        return percentage
+        return self._output(percentage)
     
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def percentage_with_number_pesticides(self, year_list, country_list, product):
-        if product == 'milk':
-            df = self.milk_dataframe
-        elif product == 'butter':
-            df = self.butter_dataframe
+        if self.pesticide_index:
+            index = self.bitmaps
+            product = product if product in ['milk', 'butter'] else 'both'
+            total_samples = index.count(['sampCountry', 'year'], product, year_list=year_list, country_list=country_list).reset_index(name='total_samples')
+            samples_with_pesticides = index.count(['sampCountry', 'year'], product, year_list=year_list, country_list=country_list, detected=True).reset_index(name='samples_with_pesticides')
+            pesticides_per_sample = index.pesticides_per_sample(['sampCountry', 'year'], product, year_list, country_list).reset_index(name='number_of_pesticides')
         else:
-            df = self.dataframe
+            if product == 'milk':
+                frame = 'milk_dataframe'
+            elif product == 'butter':
+                frame = 'butter_dataframe'
+            else:
+                frame = 'dataframe'
+            df = self._rows(frame, year_list, country_list, facts=self.sample_facts)
             
-        df = df[df['year'].isin(year_list)]
-        df = df[df['sampCountry'].isin(country_list)]
-        
-        grouped = df[~df['resVal'].isna()].groupby(['sampCountry', 'year', 'sampleId'])['pesticideCode'].count().reset_index(name='number_of_pesticides')
-        res1 = grouped.groupby(['sampCountry', 'year', 'number_of_pesticides'])['sampleId'].count().reset_index(name='samples_count')
-        total_samples = df.groupby(['sampCountry', 'year'])['sampleId'].nunique().reset_index(name='total_samples')
-        samples_with_pesticides = df[~df['resVal'].isna()].groupby(['sampCountry', 'year'])['sampleId'].nunique().reset_index(name='samples_with_pesticides')
-        pesticides_per_sample = df[~df['resVal'].isna()].groupby(['sampCountry', 'year', 'sampleId'])['pesticideCode'].count().reset_index(name='number_of_pesticides')
-        count_by_number = pesticides_per_sample.groupby(['sampCountry', 'year', 'number_of_pesticides'])['sampleId'].count().reset_index(name='samples_count')
+            total_samples = self._count(df, ['sampCountry', 'year']).reset_index(name='total_samples')
+            samples_with_pesticides = self._count(df[self._detected(df)], ['sampCountry', 'year']).reset_index(name='samples_with_pesticides')
+            pesticides_per_sample = self._pesticides_per_sample(df, ['sampCountry', 'year']).reset_index(name='number_of_pesticides')
+        count_by_number = pesticides_per_sample.groupby(['sampCountry', 'year', 'number_of_pesticides'], observed=True)['sampleId'].count().reset_index(name='samples_count')
         count_by_number = count_by_number.merge(total_samples, on=['sampCountry', 'year'], how='left')
         count_by_number = count_by_number.merge(samples_with_pesticides, on=['sampCountry', 'year'], how='left')
         count_by_number['percentage_of_all_samples'] = (count_by_number['samples_count'] / count_by_number['total_samples'] * 100).round(2)
@@ -219,211 +539,193 @@ class DataAggregator:
             count_by_number['samples_count'] / count_by_number['samples_with_pesticides'].replace(0, np.nan) * 100
         ).round(2).fillna(0)
 
-        return count_by_number
+        return self._output(count_by_number)
     
     # 2.4.
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def percentage_with_pesticides_limits(self, year_list, country_list, product, limits_path, sample_id = False):
         if product == 'milk':
-            df = self.milk_dataframe
+            frame = 'milk_dataframe'
         elif product == 'butter':
-            df = self.butter_dataframe
+            frame = 'butter_dataframe'
         else:
-            df = self.butter_dataframe
+            frame = 'butter_dataframe'
             print('For both products, no obligatory years are considered.')
-            
-        df = df[df['year'].isin(year_list)]
-        df = df[df['sampCountry'].isin(country_list)]
+        df = self._rows(frame, year_list, country_list)
         
-        df_limits = self._get_paramcodes_limits(path=limits_path)
-        
-        res1 = pd.merge(df, df_limits, left_on='pesticideCode', right_on='code', how='left')
+        res1 = get_registry(limits_path).join(df, how='left')
         res1 = res1[res1['limit'].notna()]
         res1['resVal'] = res1['resVal'].fillna(0)
-        res1['acceptable'] = res1['resVal'] <= res1['limit']
+        res1['acceptable'] = res1['resVal'] <= res1['limit'].astype(res1['resVal'].dtype)
         res1 = res1[res1['acceptable'] == False]
-        if product == 'milk':
-            obligatory_year_list = [2013, 2016, 2019, 2022]
-        elif product == 'butter':
-            obligatory_year_list = [2012, 2015]
-        else:
-            obligatory_year_list = []
+        if self.chunked:
+            # the frame only holds detections, the rows keep the index they have among all residue rows
+            res1.index = self._row_positions(frame, df.index.to_numpy()[res1.index.to_numpy()], year_list, country_list)
+        obligatory_year_list = self.obligatory_years[frame] if product in ['milk', 'butter'] else []
         res1['obligatory_programme'] = (res1['year'].isin(obligatory_year_list) & res1['progType'].isin(['K009A', 'K018A']))
-        res2 = df.groupby(['sampCountry', 'year'])['sampleId'].nunique().reset_index(name='total_count')
-        res2_indexed = res2.set_index(['sampCountry', 'year'])['total_count'].to_dict()
+        res2_indexed = self._samples(frame, ['sampCountry', 'year'], year_list, country_list).to_dict()
 
         res1_index = res1.set_index(['sampCountry', 'year'])
         res1['total_samples'] = res1_index.index.map(res2_indexed.get)
-        unacceptable_counts = res1.groupby(['sampCountry', 'year'])['sampleId'].nunique().to_dict()
+        unacceptable_counts = res1.groupby(['sampCountry', 'year'], observed=True)['sampleId'].nunique().to_dict()
         res1['unacceptable_count'] = res1_index.index.map(unacceptable_counts.get)
         res1['unacceptable_percentage'] = (100 * res1['unacceptable_count'] / res1['total_samples']).round(2)
         
         if sample_id:
-            res1['customSampleId'] = res1['sampleId'].astype(str).str[-5:]
+            res1['customSampleId'] = self._sample_ids(res1['sampleId']).astype(str).str[-5:]
             res1 = res1[['year', 'customSampleId', 'sampCountry', 'origCountry', 'progType', 'name', 'limit', 'resVal', 'acceptable', 'obligatory_programme', 'total_samples', 'unacceptable_count', 'unacceptable_percentage']]
         else:
             res1 = res1[['year', 'sampCountry', 'origCountry', 'progType', 'name', 'limit', 'resVal', 'acceptable', 'obligatory_programme', 'total_samples', 'unacceptable_count', 'unacceptable_percentage']]
             
-        return res1
+        return self._output(res1)
         
         
     
     # 2.5.
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def country_pesticides(self, year_list, country_list, paramcodes_path, top_k = 10, product = 'both', programme='obligatory'):
         if product == 'milk':
-            df_source = self.milk_dataframe
+            source = 'milk_dataframe'
             if programme == 'obligatory':
-                df = self.milk_obligatory_dataframe.copy()
+                frame = 'milk_obligatory_dataframe'
             elif programme == 'voluntary':
-                df = self.milk_voluntary_dataframe.copy()
+                frame = 'milk_voluntary_dataframe'
             else:
-                df = self.milk_dataframe
+                frame = 'milk_dataframe'
         elif product == 'butter':
-            df_source = self.butter_dataframe
+            source = 'butter_dataframe'
             if programme == 'obligatory':
-                df = self.butter_obligatory_dataframe.copy()
+                frame = 'butter_obligatory_dataframe'
             elif programme == 'voluntary':
-                df = self.butter_voluntary_dataframe.copy()
+                frame = 'butter_voluntary_dataframe'
             else:
-                df = self.butter_dataframe
+                frame = 'butter_dataframe'
         else:
-            df_source = self.dataframe
-            df = self.dataframe
+            source = 'dataframe'
+            frame = 'dataframe'
             print('For both products, no obligatory years are considered.')
         
-        df = df[df['year'].isin(year_list)]
-        df = df[df['origCountry'].isin(country_list)]
-        df = df[~df['resVal'].isna()]
-        
-        df_top_pesticides = df.groupby(['origCountry', 'pesticideCode'])['sampleId'].nunique().reset_index(name='samples_count')
-        df_top_pesticides = df_top_pesticides.sort_values(['origCountry', 'samples_count'], ascending=[True, False])
-        df_top_pesticides = df_top_pesticides.groupby('origCountry').head(top_k).reset_index(drop=True)
-        top_pesticides_list = df_top_pesticides['pesticideCode'].unique().tolist()
-        
-        df_samples = df_source.groupby(['origCountry'])['sampleId'].nunique()
+        if self.sql is not None:
+            res = self.sql.top_pesticide_samples(frame, year_list, country_list, top_k)
+        else:
+            counts = self.query(*self._cell(frame), year_list, country_list, 'origCountry', 'detected', ['origCountry', 'pesticideCode'])
+            
+            df_top_pesticides = grouped_top_k(counts.reset_index(name='samples_count'), 'origCountry', 'samples_count', top_k).reset_index(drop=True)
+            top_pesticides_list = df_top_pesticides['pesticideCode'].unique().tolist()
+            
+            res = counts[counts.index.get_level_values('pesticideCode').isin(top_pesticides_list)].reset_index(name='pesticides_count')
         
-        res = df[df['pesticideCode'].isin(top_pesticides_list)]
-        res = res.groupby(['origCountry', 'pesticideCode'])['sampleId'].nunique().reset_index(name='pesticides_count')
+        df_samples = self._samples(source, ['origCountry'])
         res = res.merge(df_samples.reset_index(name='sample_count'), on='origCountry', how='left')
         res['percentage'] = (res['pesticides_count'] / res['sample_count'] * 100).round(2)
         
-        df_names = self._get_paramcodes_limits(path=paramcodes_path)
-        res = pd.merge(res, df_names, left_on='pesticideCode', right_on='code')
+        res = get_registry(paramcodes_path).join(res)
 
         pivot = res.pivot(index='name', columns='origCountry', values='percentage').fillna(0)
         pivot.reset_index(inplace=True)
-        return pivot
+        return self._output(pivot)
     
     # 3
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def pesticides_sampling_relation(self, year_list, country_list, product, programme):
         if product == 'milk':
             if programme == 'obligatory':
-                df = self.milk_obligatory_dataframe.copy()
+                frame = 'milk_obligatory_dataframe'
             elif programme == 'voluntary':
-                df = self.milk_voluntary_dataframe.copy()
+                frame = 'milk_voluntary_dataframe'
             else:
-                df = self.milk_dataframe
+                frame = 'milk_dataframe'
         elif product == 'butter':
             if programme == 'obligatory':
-                df = self.butter_obligatory_dataframe.copy()
+                frame = 'butter_obligatory_dataframe'
             elif programme == 'voluntary':
-                df = self.butter_voluntary_dataframe.copy()
+                frame = 'butter_voluntary_dataframe'
             else:
-                df = self.butter_dataframe
+                frame = 'butter_dataframe'
         else:
-            df = self.dataframe
-
-        df = df[df['year'].isin(year_list)]
-        df = df[df['sampCountry'].isin(country_list)]
+            frame = 'dataframe'
         
-        df_pesticides = df[~df['resVal'].isna()]
-        df_pesticides = df_pesticides.groupby(['sampCountry', 'year'])['sampleId'].nunique().reset_index(name='pesticides_samples_count')
+        df_pesticides = self._samples(frame, ['sampCountry', 'year'], year_list, country_list, measure='positive_samples').reset_index(name='pesticides_samples_count')
         
-        df = df.groupby(['sampCountry', 'year'])['sampleId'].nunique().reset_index(name='samples_count')      
+        df = self._samples(frame, ['sampCountry', 'year'], year_list, country_list).reset_index(name='samples_count')      
         
         res = pd.merge(df, df_pesticides, on=['sampCountry', 'year'], how='left')
         res['pesticides_samples_count'] = res['pesticides_samples_count'].fillna(0).astype(int)
-        return res
+        return self._output(res)
     
     # 5
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def count_detected_pesticides(self, year_list, country_list, product):
         if product == 'milk':
-            df = self.milk_dataframe
-            df_obligatory = self.milk_obligatory_dataframe.copy()
+            frame = 'milk_dataframe'
         elif product == 'butter':
-            df = self.butter_dataframe
-            df_obligatory = self.butter_obligatory_dataframe.copy()
+            frame = 'butter_dataframe'
         else:
-            df = self.butter_dataframe
-            df_obligatory = self.butter_obligatory_dataframe.copy()
+            frame = 'butter_dataframe'
             print('For both products, no obligatory years are considered.')
         
-        df = df[df['year'].isin(year_list)]
-        df = df[df['sampCountry'].isin(country_list)]
-        df = df[~df['resVal'].isna()]
-        res = df.groupby(['sampCountry', 'year'])['sampleId'].nunique().reset_index(name='unique_sample_with_pesticides_count')
-        
-        df_obligatory = df_obligatory[df_obligatory['year'].isin(year_list)]
-        df_obligatory = df_obligatory[df_obligatory['sampCountry'].isin(country_list)]
-        df_obligatory = df_obligatory[~df_obligatory['resVal'].isna()]
-        df_obligatory = df_obligatory.groupby(['sampCountry', 'year'])['sampleId'].nunique().reset_index(name='obligatory_unique_sample_with_pesticides_count')
+        res = self._samples(frame, ['sampCountry', 'year'], year_list, country_list, measure='positive_samples').reset_index(name='unique_sample_with_pesticides_count')
+        df_obligatory = self._samples(frame.replace('_', '_obligatory_'), ['sampCountry', 'year'], year_list, country_list, measure='positive_samples').reset_index(name='obligatory_unique_sample_with_pesticides_count')
         
-        res = pd.merge(res, df_obligatory, on=['year', 'sampCountry'], how='left').fillna(0)
+        res = self._fill_zero(pd.merge(res, df_obligatory, on=['year', 'sampCountry'], how='left'))
         res['obligatory_unique_sample_with_pesticides_count'] = res['obligatory_unique_sample_with_pesticides_count'].astype(int)
         res['voluntary_unique_sample_with_pesticides_count'] = (res['unique_sample_with_pesticides_count'] - res['obligatory_unique_sample_with_pesticides_count']).astype(int)
         
         
-        return res
+        return self._output(res)
     
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def yearly_top_pesticides(self, year_list, country_list, product, top_k = 5):
         if product == 'milk':
-            df = self.milk_dataframe
-            df_obligatory = self.milk_obligatory_dataframe.copy()
+            frame = 'milk_dataframe'
         elif product == 'butter':
-            df = self.butter_dataframe
-            df_obligatory = self.butter_obligatory_dataframe.copy()
+            frame = 'butter_dataframe'
         else:
-            df = self.butter_dataframe
-            df_obligatory = self.butter_obligatory_dataframe.copy()
+            frame = 'butter_dataframe'
             print('For both products, no obligatory years are considered.')
-            
-        df = df[df['year'].isin(year_list)]
-        df = df[df['sampCountry'].isin(country_list)]
-        df = df[~df['resVal'].isna()]
-        res = df.groupby(['year', 'sampCountry'])['sampleId'].nunique().reset_index(name='unique_sample_with_pesticides_count')
         
-        df_obligatory = df_obligatory[df_obligatory['year'].isin(year_list)]
-        df_obligatory = df_obligatory[df_obligatory['sampCountry'].isin(country_list)]
-        df_obligatory = df_obligatory[~df_obligatory['resVal'].isna()]
-        df_obligatory = df_obligatory.groupby(['sampCountry', 'year'])['sampleId'].nunique().reset_index(name='obligatory_unique_sample_with_pesticides_count')
+        res = self._samples(frame, ['year', 'sampCountry'], year_list, country_list, measure='positive_samples').reset_index(name='unique_sample_with_pesticides_count')
+        df_obligatory = self._samples(frame.replace('_', '_obligatory_'), ['sampCountry', 'year'], year_list, country_list, measure='positive_samples').reset_index(name='obligatory_unique_sample_with_pesticides_count')
         
-        res = pd.merge(res, df_obligatory, on=['year', 'sampCountry'], how='left').fillna(0)
+        res = self._fill_zero(pd.merge(res, df_obligatory, on=['year', 'sampCountry'], how='left'))
         res['obligatory_unique_sample_with_pesticides_count'] = res['obligatory_unique_sample_with_pesticides_count'].astype(int)
         res['voluntary_unique_sample_with_pesticides_count'] = (res['unique_sample_with_pesticides_count'] - res['obligatory_unique_sample_with_pesticides_count']).astype(int)
         
         
-        res = res.sort_values(['year', 'unique_sample_with_pesticides_count'], ascending=[True, False])
-        res = res.groupby('year').head(top_k).reset_index(drop=True)
-        return res
+        res = grouped_top_k(res, 'year', 'unique_sample_with_pesticides_count', top_k).reset_index(drop=True)
+        return self._output(res)
     
     # 6
     
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def number_of_pesticides(self, year_list: list, product='both'):
-        if product == 'milk':
-            df = self.milk_dataframe
-        elif product == 'butter':
-            df = self.butter_dataframe
+        if self.pesticide_index:
+            # all samples performed, pesticides of the samples with a detection
+            product = product if product in ['milk', 'butter'] else 'both'
+            df_all_samples = self.bitmaps.count(['year'], product).reset_index(name='totalSamplesCount')
+            df_pests = self.bitmaps.pesticides_per_sample(['year'], product).reset_index(name='pesticideCount')
         else:
-            df = self.dataframe
-        
-        # all samples performed
-        df_all_samples = df.groupby(['year'])['sampleId'].nunique().reset_index(name='totalSamplesCount')
-        
-        # samples with >1 pesticide
-        df_pests = df[~df['resVal'].isna()]
-        df_pests = df_pests.groupby(['year', 'sampleId'])['pesticideCode'].count().reset_index(name='pesticideCount')
-        df_pests = df_pests.groupby(['year', 'pesticideCount'])['sampleId'].nunique().reset_index(name='sampleCount')
+            if product == 'milk':
+                df = self._table('milk_dataframe')
+            elif product == 'butter':
+                df = self._table('butter_dataframe')
+            else:
+                df = self._table('dataframe')
+            
+            # all samples performed
+            df_all_samples = self._count(df, ['year']).reset_index(name='totalSamplesCount')
+            
+            # samples with >1 pesticide
+            df_pests = self._pesticides_per_sample(df, ['year']).reset_index(name='pesticideCount')
+        df_pests = df_pests.groupby(['year', 'pesticideCount'], observed=True)['sampleId'].nunique().reset_index(name='sampleCount')
         
-        df_positive_samples = df_pests.groupby(['year'])['sampleCount'].sum().reset_index(name='totalPositiveSamples')
+        df_positive_samples = df_pests.groupby(['year'], observed=True)['sampleCount'].sum().reset_index(name='totalPositiveSamples')
         
         df_zero_samples = pd.merge(df_all_samples, df_positive_samples, on=['year'])
         df_zero_samples['totalNegativeSamples'] = df_zero_samples['totalSamplesCount'] - df_zero_samples['totalPositiveSamples'] 
@@ -436,100 +738,242 @@ class DataAggregator:
         df_pests = pd.concat([df_pests, df_zero_samples], ignore_index=True).sort_values(['year', 'pesticideCount']).reset_index(drop=True)
         df_pests = pd.merge(df_pests, df_all_samples, on=['year'])
         df_pests['percentage'] = (100 * df_pests['sampleCount'] / df_pests['totalSamplesCount']).round(2)
-        return df_pests
+        return self._output(df_pests)
+    
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
+    def samples_with_pesticides(self, year_list, country_list, product, all_of=None, any_of=None, min_pesticides=None, programme='all', country='sampCountry'):
+        # samples with every pesticide code of all_of, any code of any_of and at least min_pesticides codes, from the bitmap index
+        product = product if product in ['milk', 'butter'] else 'both'
+        conditions = dict(year_list=year_list, country_list=country_list, country=country, programme=programme)
+        res = self.bitmaps.count([country, 'year'], product, all_of=all_of, any_of=any_of, min_pesticides=min_pesticides, **conditions).reset_index(name='samples_count')
+        total_samples = self.bitmaps.count([country, 'year'], product, **conditions)
+        res['total_samples'] = total_samples.reindex(pd.MultiIndex.from_frame(res[[country, 'year']])).to_numpy()
+        res['percentage'] = self._percentage(res['samples_count'], [res[country], res['year']], total_samples).round(2)
+        return self._output(res)
     
     # 7
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def country_pesticide_relation(self, year_list, country_list, product, paramcodes_path, top_k=5, programme=None):
         if product == 'milk':
             if programme == 'obligatory':
-                df_source = self.milk_obligatory_dataframe
+                source = 'milk_obligatory_dataframe'
             elif programme == 'voluntary':
-                df_source = self.milk_voluntary_dataframe
+                source = 'milk_voluntary_dataframe'
             else:
-                df_source = self.milk_dataframe
+                source = 'milk_dataframe'
         elif product == 'butter':
             if programme == 'obligatory':
-                df_source = self.butter_obligatory_dataframe
+                source = 'butter_obligatory_dataframe'
             elif programme == 'voluntary':
-                df_source = self.butter_voluntary_dataframe
+                source = 'butter_voluntary_dataframe'
             else:
-                df_source = self.butter_dataframe
+                source = 'butter_dataframe'
         else:
-            df_source = self.dataframe
+            source = 'dataframe'
 
-        df = df_source[df_source['year'].isin(year_list)]
-        df = df[df['origCountry'].isin(country_list)]
-        df = df[~df['resVal'].isna()]
-        result = df.groupby(['origCountry', 'pesticideCode'])['sampleId'].count().reset_index(name='sample_count')
-        result = result.sort_values(['origCountry', 'sample_count'], ascending=[True, False]).reset_index(drop=True)
+        if self.sql is not None:
+            result = self.sql.pesticide_results(source, year_list, country_list)
+        else:
+            result = self.query(*self._cell(source), year_list, country_list, 'origCountry', 'detected', ['origCountry', 'pesticideCode'], 'rows').reset_index(name='sample_count')
 
-        df_names = self._get_paramcodes_limits(path=paramcodes_path)
-        result = pd.merge(result, df_names, left_on='pesticideCode', right_on='code')
+        result = get_registry(paramcodes_path).join(result)
 
-        total_samples_per_country = df_source[df_source['origCountry'].isin(country_list) & df_source['year'].isin(year_list)].groupby('origCountry')['sampleId'].nunique()
-        result['percentage'] = result.apply(lambda row: (row['sample_count'] / total_samples_per_country[row['origCountry']]) * 100, axis=1)
-        result['percentage'] = result['percentage'].round(2)
-        result = result.groupby('origCountry').head(top_k).reset_index(drop=True)
-        return result
+        total_samples_per_country = self._samples(source, ['origCountry'], year_list, country_list, 'origCountry')
+        result['percentage'] = self._percentage(result['sample_count'], [result['origCountry']], total_samples_per_country).round(2)
+        result = grouped_top_k(result, 'origCountry', 'sample_count', top_k).reset_index(drop=True)
+        return self._output(result)
         
         
     # 8 
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def voluntary_programmes_ranking(self, year_list, country_list, product, country_type, top_k=5):
-        if product == 'milk':
-            df = self.milk_voluntary_dataframe
-        elif product == 'butter':
-            df = self.butter_voluntary_dataframe
-        else:
+        if product not in ['milk', 'butter']:
             print('Wrong product.')
             return
         
         country = 'origCountry' if country_type == 'origin' else 'sampCountry'
         
-        df = df[~df['resVal'].isna()]
-        df = df.groupby(['year', country])['sampleId'].nunique().reset_index(name='positive_sample_count')
+        df = self._samples(f'{product}_voluntary_dataframe', ['year', country], measure='positive_samples').reset_index(name='positive_sample_count')
         df = df.sort_values(['year', 'positive_sample_count'], ascending=[True, False])
-        return df
+        return self._output(df)
     
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
     def voluntary_sampling_stats(self, year_list, country_list, product, country_type, limits_path):
-        if product == 'milk':
-            df = self.milk_voluntary_dataframe
-        elif product == 'butter':
-            df = self.butter_voluntary_dataframe
-        else:
+        if product not in ['milk', 'butter']:
             print('Wrong product.')
             return
         
         country = 'origCountry' if country_type == 'origin' else 'sampCountry'
         
-        df = df[df['year'].isin(year_list)]
-        df = df[df[country].isin(country_list)]
-        
         # VAL > 0
-        df1 = df[~df['resVal'].isna()]
-        df1 = df1.groupby(['year', country])['sampleId'].nunique().reset_index(name='VAL_samples')
+        df1 = self._samples(f'{product}_voluntary_dataframe', ['year', country], year_list, country_list, country, measure='positive_samples').reset_index(name='VAL_samples')
         
         # Limits exceeded
-        df_limits = self._get_paramcodes_limits(path=limits_path)
-        df2 = pd.merge(df, df_limits, left_on='pesticideCode', right_on='code', how='left').fillna(0)
-        df2['acceptable'] = df2['limit'] >= df2['resVal']
-        df2 = df2[df2['acceptable'] == False]
-        df2 = df2.groupby(['year', country])['sampleId'].nunique().reset_index(name='limit_samples')
+        df2 = self.query(product, 'voluntary', year_list, country_list, country, 'exceeds', ['year', country], paramcodes_path=limits_path).reset_index(name='limit_samples')
         
         # total samples
-        df3 = df.groupby(['year', country])['sampleId'].nunique().reset_index(name='total_samples')
+        df3 = self._samples(f'{product}_voluntary_dataframe', ['year', country], year_list, country_list, country).reset_index(name='total_samples')
         
-        res = pd.merge(df3, df1, on=['year', country], how='left').fillna(0)
-        res = pd.merge(res, df2, on=['year', country], how='left').fillna(0)
+        res = self._fill_zero(pd.merge(df3, df1, on=['year', country], how='left'))
+        res = self._fill_zero(pd.merge(res, df2, on=['year', country], how='left'))
         
-        return res
+        return self._output(res)
+        
+    # 9
+    @traced('aggregator', rows_in=_input_rows)
+    @memoized
+    def pesticide_co_occurrence(self, year_list, country_list, product, paramcodes_path, programme=None, by=None, country='sampCountry'):
+        # pesticides detected together in a sample, for every pair of names, per group of the by columns (year and/or country)
+        if product in ['milk', 'butter']:
+            source = f'{product}_{programme}_dataframe' if programme in ['obligatory', 'voluntary'] else f'{product}_dataframe'
+        else:
+            source = 'dataframe'
+        by = list(by or [])
+        
+        df = self._rows(source, year_list, country_list, country, 'positive_samples')
+        # the names of _get_paramcodes_limits, codes of one name are one pesticide
+        df = get_registry(paramcodes_path).join(df[by + ['sampleId', 'pesticideCode']])
+        
+        if by:
+            totals = self._samples(source, by, year_list, country_list, country)
+        else:
+            samples = self._rows(source, year_list, country_list, country, facts=self.sample_facts)
+            totals = samples['sampleId'].nunique()
+        matrix, groups, pesticides = detection_matrix(df, by)
+        return self._output(co_occurrence(matrix, groups, pesticides, totals))
+    
+    # query
+    def query(self, product: str = 'both', programme: str = 'all', year_list: list = None, country_list: list = None, country: str = 'sampCountry',
+              predicate: str = None, keys: list = None, measure: str = 'samples', paramcodes_path: str = None):
+        # measure per group of keys over the rows of product and programme in these years and countries of the country axis
+        # (sampCountry or origCountry) passing the predicate: None, 'detected', 'val' (a VAL result) or 'exceeds' (a detection above
+        # its limit in paramcodes_path, no limit counts as 0). measure is 'samples' (distinct samples) or 'rows' (residue rows),
+        # a 'name' key groups by the pesticide names of paramcodes_path and drops the codes it does not know.
+        # the filters are one mask, only the columns the group-by reads are taken from the frame, in one take
+        keys = list(keys or [])
+        if predicate not in PREDICATES:
+            raise ValueError(f'Unknown predicate {predicate}, use one of {PREDICATES}.')
+        if measure not in MEASURES:
+            raise ValueError(f'Unknown measure {measure}, use one of {MEASURES}.')
+        if programme != 'all' and product not in ['milk', 'butter']:
+            raise ValueError('Programmes are only defined for milk and butter.')
+        if ('name' in keys or predicate == 'exceeds') and paramcodes_path is None:
+            raise ValueError('Pesticide names and limits need paramcodes_path.')
+        per_pesticide = 'name' in keys or 'pesticideCode' in keys
+        
+        if measure == 'samples' and predicate != 'exceeds':
+            # sample counts from the sketches or the cube
+            sample_measure = {None: 'samples', 'detected': 'positive_samples', 'val': 'val_samples'}[predicate]
+            if self.approximate and 'name' in keys:
+                return self.sketches.pesticide_counts(keys, product, programme, year_list, country_list, country, names=get_registry(paramcodes_path))
+            if (self.approximate or self.use_cube) and not per_pesticide:
+                counts = self.sketches if self.approximate else self.cube
+                return counts.counts(keys, product, programme, sample_measure, year_list=year_list, country_list=country_list, country=country)
+        
+        # one row per sample when no key or predicate needs the residue rows
+        facts = self.sample_facts and measure == 'samples' and predicate != 'exceeds' and not per_pesticide
+        df, mask = self._filtered(product, programme, year_list, country_list, country, predicate, facts)
+        columns = [key for key in keys if key != 'name'] + ['sampleId']
+        if 'name' in keys or predicate == 'exceeds':
+            columns += ['pesticideCode', 'resVal']
+        columns = list(dict.fromkeys(columns))
+        positions = np.flatnonzero(mask) if mask is not None else np.arange(len(df))
+        rows = df.iloc[positions, df.columns.get_indexer(columns)]
+        
+        if 'name' in keys or predicate == 'exceeds':
+            registry = get_registry(paramcodes_path)
+            ids = registry.ids(rows['pesticideCode'])
+            keep = ids >= 0 if 'name' in keys else np.ones(len(rows), dtype=bool)
+            if predicate == 'exceeds':
+                values = rows['resVal'].to_numpy()
+                limits = registry.limits[ids]
+                keep &= ~(np.where(np.isnan(limits), 0, limits).astype(values.dtype) >= values)
+            rows = rows[keep]
+            if 'name' in keys:
+                rows = rows.assign(name=registry.names[ids[keep]])
+        
+        if measure == 'rows':
+            return rows.groupby(keys, observed=True)['sampleId'].count()
+        if facts:
+            return count_samples(rows, keys)
+        return rows.groupby(keys, observed=True)['sampleId'].nunique()
+    
+    def cache_report(self):
+        return self.cache.report() if self.cache is not None else None
+    
+    def memory_usage(self):
+        # only the frames loaded so far
+        reports = [memory_report(self.__dict__[name]).assign(frame=name) for name in FRAMES + list(FACTS.values()) if name in self.__dict__]
+        return pd.concat(reports, ignore_index=True)[['frame', 'column', 'dtype', 'memory_mb']]
+    
+    def _output(self, res):
+        # results always come back in the plain schema, whatever the frames are stored in
+        if self.schema is None:
+            return res
+        return self.schema.restore(res)
+    
+    def _percentage(self, counts, keys, totals):
+        # counts as a percentage of the totals looked up by the key columns, in one vectorized pass
+        index = pd.MultiIndex.from_arrays(keys) if len(keys) > 1 else keys[0]
+        return counts.to_numpy() / totals.reindex(index).to_numpy() * 100
+    
+    def _frame_names(self):
+        return FRAMES + list(FACTS.values()) if self.sample_facts else FRAMES + MASKS
+    
+    def _detected(self, df):
+        return df['has_detection'] if 'has_detection' in df else ~df['resVal'].isna()
+    
+    def _has_val(self, df):
+        return df['has_val'] if 'has_val' in df else df['resType'] == 'VAL'
+    
+    def _count(self, df, keys):
+        # distinct samples per group, a plain row count on a fact table with unique sample ids
+        if 'has_detection' in df:
+            return count_samples(df, keys)
+        return df.groupby(keys, observed=True)['sampleId'].nunique()
+    
+    def _pesticides_per_sample(self, df, keys):
+        if 'has_detection' in df:
+            return pesticides_per_sample(df, keys)
+        return df[~df['resVal'].isna()].groupby(keys + ['sampleId'], observed=True)['pesticideCode'].count()
+    
+    def _pesticide_samples(self, frame, keys, year_list, country_list, paramcodes_path, country='sampCountry'):
+        # samples with a detection of each pesticide name per group of keys
+        return self.query(*self._cell(frame), year_list, country_list, country, 'detected', keys + ['name'], paramcodes_path=paramcodes_path)
+    
+    def _cell(self, name):
+        # product and programme of a frame, as the cube and the sketches name them
+        product = name.split('_')[0] if name != 'dataframe' else 'both'
+        programme = name.split('_')[1] if name.count('_') == 2 else 'all'
+        return product, programme
+    
+    def _pesticide_rows(self, year_list, country_list):
+        # residue rows per country, year and pesticide, with or without a detection
+        if self.chunked:
+            rows = self.partials.pesticide_rows
+            return rows[rows.index.get_level_values('year').isin(year_list) & rows.index.get_level_values('sampCountry').isin(country_list)]
+        return self.query('both', year_list=year_list, country_list=country_list, keys=['sampCountry', 'year', 'pesticideCode'], measure='rows')
+    
+    def _row_positions(self, frame, row_ids, year_list, country_list):
+        # positions of rows of the frame among all its residue rows in these years and countries, found by a pass over the store
+        product = {'dataframe': 'both', 'milk_dataframe': 'milk', 'butter_dataframe': 'butter'}[frame]
+        filters = dict(self.store_filters)
+        filters['year_list'] = [year for year in year_list if filters['year_list'] is None or year in filters['year_list']]
+        filters['country_list'] = [country for country in country_list if filters['country_list'] is None or country in filters['country_list']]
+        return row_positions(row_ids, self.store_dir, product, **filters)
+    
+    def _fill_zero(self, df):
+        # same as fillna(0), but category columns cannot take a value outside their dictionary
+        return df.fillna({col: 0 for col in df.columns if not isinstance(df[col].dtype, pd.CategoricalDtype)})
+    
+    def _sample_ids(self, sample_ids):
+        if self.schema is None:
+            return sample_ids
+        return self.schema.decode_samples(sample_ids)
         
     def _get_paramcodes_limits(self, path: str):
-        paramcodes = pd.read_csv(path)
-        paramcodes = paramcodes.rename(columns={"SKRÓT [EN]" : "name",
-                                                "PEŁNA NAZWA [EN]" : "full_name",
-                                                "PARAMCODE : WARTOŚĆ" : "paramcode_limit"})
-        paramcodes
-        paramcodes[['code', 'limit']] = paramcodes['paramcode_limit'].str.extract(r'“?([^”"]+)”?\s*:\s*([^\s]+)')
-        paramcodes['limit'] = pd.to_numeric(paramcodes['limit'], errors='coerce').fillna(float('inf'))
-        paramcodes = paramcodes[['name', 'full_name', 'code', 'limit']]
-        return paramcodes
\ No newline at end of file
+        return get_registry(path).frame.copy()
@@ -0,0 +1,168 @@
+import os
+import numpy as np
+import pandas as pd
+
+from src.cube import _plain
+from src.facts import FACT_KEYS
+
+# a code found in fewer than 1 of ARRAY_DENSITY samples of a partition keeps its sorted sample positions instead of
+# a bitmap, like the array and bitmap containers of roaring bitmaps, whichever is smaller
+ARRAY_DENSITY = 32
+
+
+class BitmapPartition:
+    def __init__(self, samples: pd.DataFrame, detected: np.ndarray, pesticides: dict, repeats: pd.Series):
+        # the fact rows of one product and year, bit i of every bitmap stands for row i
+        self.samples = samples
+        # packed bits of the samples with any detection
+        self.detected = detected
+        # pesticide code -> uint32 sample positions or packed bits
+        self.pesticides = pesticides
+        # detections of a code a sample already had, per sample position, counted by the multi-residue metrics like the residue rows
+        self.repeats = repeats
+        self._planes = None
+
+    def bits(self, code):
+        container = self.pesticides.get(code)
+        if container is None:
+            return self.empty()
+        if container.dtype == np.uint8:
+            return container
+        return _pack(container, len(self.samples))
+
+    def empty(self):
+        return np.zeros((len(self.samples) + 7) // 8, dtype=np.uint8)
+
+    def full(self):
+        return _pack(np.arange(len(self.samples)), len(self.samples))
+
+    def where(self, mask):
+        return np.packbits(np.asarray(mask, dtype=bool))
+
+    def planes(self):
+        # bit-sliced counter of the codes per sample, plane i holds bit i of every sample's count
+        if self._planes is None:
+            planes = []
+            for code in self.pesticides:
+                carry = self.bits(code)
+                for i, plane in enumerate(planes):
+                    planes[i], carry = plane ^ carry, plane & carry
+                    if not carry.any():
+                        break
+                else:
+                    if carry.any():
+                        planes.append(carry)
+            self._planes = planes
+        return self._planes
+
+    def at_least(self, k: int):
+        # samples with k or more codes, compared plane by plane from the highest bit down
+        planes = self.planes()
+        if k <= 0:
+            return self.full()
+        if k >= 2 ** len(planes):
+            return self.empty()
+        greater, equal = self.empty(), ~self.empty()
+        for i in reversed(range(len(planes))):
+            if (k >> i) & 1:
+                equal = equal & planes[i]
+            else:
+                greater = greater | (equal & planes[i])
+                equal = equal & ~planes[i]
+        return greater | equal
+
+    def counts(self, positions: np.ndarray):
+        # number of codes of the samples at these positions
+        counts = np.zeros(len(positions), dtype='int64')
+        for i, plane in enumerate(self.planes()):
+            counts += np.unpackbits(plane, count=len(self.samples))[positions].astype('int64') << i
+        return counts
+
+
+class PesticideBitmaps:
+    def __init__(self, partitions: dict):
+        # (product, year) -> BitmapPartition
+        self.partitions = partitions
+
+    @classmethod
+    def build(cls, facts_by_product: dict, detections_by_product: dict):
+        # facts_by_product holds the sample facts, detections_by_product the residue rows with a result, both per product
+        partitions = {}
+        for product, facts in facts_by_product.items():
+            facts = _plain(facts)
+            detections = detections_by_product[product]
+            detections = _plain(detections[detections['resVal'].notna()][FACT_KEYS + ['pesticideCode']])
+            detections = detections[detections['pesticideCode'].notna()]
+            for year, samples in facts.groupby('year', sort=True):
+                samples = samples.reset_index(drop=True)
+                rows = detections[detections['year'] == year].merge(samples[FACT_KEYS].reset_index(names='position'), on=FACT_KEYS, how='left')
+                pairs = rows.groupby(['pesticideCode', 'position'], sort=True).size()
+                pesticides = {}
+                for code, part in pairs.groupby(level='pesticideCode', sort=True):
+                    positions = part.index.get_level_values('position').to_numpy(dtype=np.uint32)
+                    pesticides[code] = positions if len(positions) * ARRAY_DENSITY < len(samples) else _pack(positions, len(samples))
+                repeats = (pairs - 1)[pairs > 1].groupby(level='position').sum()
+                detected = np.packbits(samples['has_detection'].to_numpy(dtype=bool))
+                partitions[(product, int(year))] = BitmapPartition(samples, detected, pesticides, repeats)
+        return cls(partitions)
+
+    def samples_with(self, product: str, all_of: list = None, any_of: list = None, min_pesticides: int = None, year_list: list = None, country_list: list = None,
+                     country: str = 'sampCountry', programme: str = 'all', detected: bool = False):
+        # fact rows of the samples with every code of all_of, at least one of any_of and min_pesticides codes or more,
+        # with their number of codes in n_pesticides
+        parts = []
+        for (name, year), partition in self.partitions.items():
+            if name != product or (year_list is not None and year not in year_list):
+                continue
+            bits = partition.detected if detected else partition.full()
+            for code in all_of or []:
+                bits = bits & partition.bits(code)
+            if any_of:
+                bits = bits & np.bitwise_or.reduce([partition.bits(code) for code in any_of])
+            if min_pesticides is not None:
+                bits = bits & partition.at_least(min_pesticides)
+            if country_list is not None:
+                bits = bits & partition.where(partition.samples[country].isin(country_list))
+            if programme != 'all':
+                bits = bits & partition.where(partition.samples[programme])
+            positions = np.flatnonzero(np.unpackbits(bits, count=len(partition.samples)))
+            parts.append(partition.samples.iloc[positions].assign(n_pesticides=partition.counts(positions)))
+        if not parts:
+            return pd.DataFrame(columns=FACT_KEYS + ['n_pesticides'])
+        return pd.concat(parts, ignore_index=True)
+
+    def count(self, keys: list, product: str, **conditions):
+        # distinct samples per group of keys among samples_with(product, **conditions)
+        return self.samples_with(product, **conditions).groupby(keys)['sampleId'].nunique()
+
+    def pesticides_per_sample(self, keys: list, product: str, year_list: list = None, country_list: list = None, country: str = 'sampCountry'):
+        # the Series of facts.pesticides_per_sample, pesticides per sample with a detection
+        parts = []
+        for (name, year), partition in self.partitions.items():
+            if name != product or (year_list is not None and year not in year_list):
+                continue
+            bits = partition.detected
+            if country_list is not None:
+                bits = bits & partition.where(partition.samples[country].isin(country_list))
+            positions = np.flatnonzero(np.unpackbits(bits, count=len(partition.samples)))
+            n_detected = partition.counts(positions) + partition.repeats.reindex(positions, fill_value=0).to_numpy()
+            parts.append(partition.samples.iloc[positions][keys + ['sampleId']].assign(n_detected=n_detected))
+        if not parts:
+            # same index levels as the non empty result
+            return pd.DataFrame(columns=keys + ['sampleId', 'n_detected']).astype({'n_detected': 'int64'}).groupby(keys + ['sampleId'])['n_detected'].sum()
+        return pd.concat(parts, ignore_index=True).groupby(keys + ['sampleId'])['n_detected'].sum()
+
+    def save(self, path: str):
+        tmp_path = f'{path}.tmp'
+        pd.to_pickle({key: (p.samples, p.detected, p.pesticides, p.repeats) for key, p in self.partitions.items()}, tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        return cls({key: BitmapPartition(*data) for key, data in pd.read_pickle(path).items()})
+
+
+def _pack(positions: np.ndarray, n: int):
+    bits = np.zeros(n, dtype=bool)
+    bits[positions] = True
+    return np.packbits(bits)
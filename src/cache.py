@@ -0,0 +1,129 @@
+import functools
+import inspect
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from src.facts import source_key
+from src.instrument import note
+from src.paramcodes import file_signature
+
+# size bound of the result cache, the least recently used results are removed past it
+CACHE_SIZE_MB = 512
+
+
+class ResultCache:
+    def __init__(self, cache_dir: str, max_mb: float = CACHE_SIZE_MB):
+        # one parquet file per result, named by the hash of the method, its arguments and the input it read.
+        # the file times order the results by last use
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.stats = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_or_compute(self, name: str, key: str, compute):
+        path = os.path.join(self.cache_dir, f'{name}-{key}.parquet')
+        if os.path.exists(path):
+            try:
+                res = _from_parquet(path)
+                os.utime(path)
+                self._count(name, 'hits')
+                note(cache='hit')
+                return res
+            except (OSError, ValueError):
+                # removed by another process or half written, computed again
+                pass
+        res = compute()
+        self._count(name, 'misses')
+        note(cache='miss')
+        # only frames are stored, the other results are cheap (0, None)
+        if isinstance(res, pd.DataFrame):
+            self._store(res, path)
+        return res
+
+    def report(self):
+        # hits and misses per method since this cache was opened, with the size of the cache on disk
+        rows = [{'method': name, **counts} for name, counts in sorted(self.stats.items())]
+        report = pd.DataFrame(rows, columns=['method', 'hits', 'misses']).fillna(0)
+        report[['hits', 'misses']] = report[['hits', 'misses']].astype(int)
+        report['hit_rate'] = (report['hits'] / (report['hits'] + report['misses'])).round(2)
+        print(f'{len(self._files())} results, {self._size() / 1024 / 1024:.1f} of {self.max_bytes / 1024 / 1024:.1f} MB in {self.cache_dir}')
+        return report
+
+    def clear(self):
+        for path in self._files():
+            os.remove(path)
+
+    def _store(self, res: pd.DataFrame, path: str):
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            res.to_parquet(tmp_path)
+        except (ValueError, TypeError, ImportError) as e:
+            # columns parquet cannot hold are not cached
+            print(f'Result {os.path.basename(path)} not cached: {e}')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            files = sorted(self._files(), key=lambda path: os.stat(path).st_mtime_ns)
+            size = sum(os.path.getsize(path) for path in files)
+            # the newest result stays even if it is bigger than the whole bound
+            for path in files[:-1]:
+                if size <= self.max_bytes:
+                    break
+                size -= os.path.getsize(path)
+                os.remove(path)
+
+    def _files(self):
+        return [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith('.parquet')]
+
+    def _size(self):
+        return sum(os.path.getsize(path) for path in self._files())
+
+    def _count(self, name: str, field: str):
+        with self._lock:
+            counts = self.stats.setdefault(name, {'hits': 0, 'misses': 0})
+            counts[field] += 1
+
+
+def memoized(method):
+    # results of a DataAggregator method are taken from its result cache when it has one, the key holds
+    # the arguments with defaults filled in, the signature of every file an argument names and the input data
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.cache is None:
+            return method(self, *args, **kwargs)
+        arguments = signature.bind(self, *args, **kwargs)
+        arguments.apply_defaults()
+        params = {name: _normalize(value) for name, value in arguments.arguments.items() if name != 'self'}
+        key = source_key(method.__name__, sorted(params.items()), self._dataset_key())
+        return self.cache.get_or_compute(method.__name__, key, lambda: method(self, *args, **kwargs))
+    return wrapper
+
+
+def _from_parquet(path: str):
+    res = pd.read_parquet(path)
+    for col in res.columns[res.dtypes == object]:
+        # parquet gives None for missing strings, the computed results hold NaN
+        values = res[col].to_numpy()
+        values[pd.isna(values)] = np.nan
+        res[col] = values
+    return res
+
+
+def _normalize(value):
+    # files are known by their path and signature, so an edited paramcodes or limits file gives a new key
+    if isinstance(value, str) and os.path.isfile(value):
+        return os.path.abspath(value), file_signature(value)
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.facts import build_facts, merge_facts, programme_flags, source_key
+from src.paramcodes import file_signature
+from src.store import iter_store, list_partitions, read_partition, read_store
+
+# residue rows per pesticide are kept for these keys, with or without a detection
+ROW_KEYS = ['sampCountry', 'year', 'pesticideCode']
+
+
+class StorePartials:
+    def __init__(self, facts: pd.DataFrame, detections: pd.DataFrame, pesticide_rows: pd.Series):
+        # one row per sample, every distinct sample count is taken from here
+        self.facts = facts
+        # the residue rows with a result, in store order with their rowId index, the per-pesticide metrics only read these
+        self.detections = detections
+        # residue rows per ROW_KEYS group
+        self.pesticide_rows = pesticide_rows
+
+    @classmethod
+    def scan(cls, store_dir: str, product: str = None, year_list: list = None, country_list: list = None, programme_list: list = None, obligatory_year_list: list = None, partials_dir: str = None):
+        # one partition file of residue rows in memory at a time, each one reduced to its facts, detections and
+        # per-pesticide row counts before the next is read. those are kept for every file, so memory grows with
+        # the samples and detections of the store, only the residue rows without a result are never held all at once.
+        # with partials_dir the partial aggregates of every file are kept there and only new or changed files are read,
+        # the programme flags are set after the merge, so other obligatory years do not need a new scan
+        facts, detections, pesticide_rows = [], [], []
+        for path in list_partitions(store_dir, product, year_list, country_list):
+            part_facts, part_detections, part_rows = cls._partition(path, programme_list, partials_dir)
+            facts.append(part_facts)
+            detections.append(part_detections)
+            pesticide_rows.append(part_rows)
+        if not facts:
+            empty = read_store(store_dir, product, year_list, country_list, programme_list)
+            return cls(build_facts(empty, obligatory_year_list), empty, empty.groupby(ROW_KEYS)['sampleId'].count())
+
+        detections = pd.concat(detections).sort_index(kind='stable')
+        pesticide_rows = pd.concat(pesticide_rows).groupby(level=ROW_KEYS).sum()
+        return cls(programme_flags(merge_facts(facts), obligatory_year_list), detections, pesticide_rows)
+
+    @staticmethod
+    def _partition(path: str, programme_list: list = None, partials_dir: str = None):
+        stored = None
+        if partials_dir is not None:
+            stored = os.path.join(partials_dir, f'{source_key(os.path.abspath(path), programme_list)}.pkl')
+            if os.path.exists(stored):
+                signature, partials = pd.read_pickle(stored)
+                if signature == file_signature(path):
+                    return partials
+        part = read_partition(path, programme_list)
+        partials = build_facts(part), part[part['resVal'].notna()], part.groupby(ROW_KEYS)['sampleId'].count()
+        if stored is not None:
+            os.makedirs(partials_dir, exist_ok=True)
+            tmp_path = f'{stored}.{os.getpid()}.tmp'
+            pd.to_pickle((file_signature(path), partials), tmp_path)
+            os.replace(tmp_path, stored)
+        return partials
+
+
+def row_positions(row_ids: np.ndarray, store_dir: str, product: str = None, year_list: list = None, country_list: list = None, programme_list: list = None):
+    # position of every row id among all rows read from the store with these filters,
+    # the index the in-memory frame gives those rows, found by reading only the rowId column file by file
+    positions = np.zeros(len(row_ids), dtype='int64')
+    for part in iter_store(store_dir, product, year_list, country_list, programme_list, columns=[]):
+        positions += np.searchsorted(part.index.to_numpy(), row_ids)
+    return positions
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+def detection_matrix(df: pd.DataFrame, keys: list, labels: str = 'name'):
+    # csr matrix with one row per sample and group of keys, one column per group and pesticide,
+    # 1 where the sample had a detection of it, so X.T @ X is block diagonal with one block per group
+    df = df[df[labels].notna()]
+    if keys:
+        group, groups = _factorize(df[keys])
+    else:
+        group, groups = np.zeros(len(df), dtype='int64'), pd.DataFrame(index=[0])
+    row, _ = _factorize(pd.DataFrame({'group': group, 'sampleId': df['sampleId'].to_numpy()}))
+    pesticide, pesticides = pd.factorize(df[labels], sort=True)
+    column = group * len(pesticides) + pesticide
+    matrix = sparse.csr_matrix((np.ones(len(df), dtype='int64'), (row, column)), shape=(row.max() + 1 if len(row) else 0, len(groups) * len(pesticides)))
+    # several residue rows of one pesticide in a sample count once
+    matrix.data[:] = 1
+    return matrix, groups, pd.Index(pesticides)
+
+
+def co_occurrence(matrix: sparse.csr_matrix, groups: pd.DataFrame, pesticides: pd.Index, totals=None):
+    # every pair of pesticides found together in a sample, per group: the samples with both, with each of them,
+    # lift against independence (totals are the samples of each group, with or without a detection) and Jaccard similarity
+    n = len(pesticides)
+    pairs = (matrix.T @ matrix).tocoo()
+    support = np.zeros(matrix.shape[1], dtype='int64')
+    diagonal = pairs.row == pairs.col
+    support[pairs.row[diagonal]] = pairs.data[diagonal]
+    upper = pairs.row < pairs.col
+    first, second, count = pairs.row[upper], pairs.col[upper], pairs.data[upper].astype('int64')
+    order = np.lexsort((second, first))
+    first, second, count = first[order], second[order], count[order]
+
+    res = groups.iloc[first // max(n, 1)].reset_index(drop=True)
+    res['pesticide_a'] = pesticides[first % max(n, 1)]
+    res['pesticide_b'] = pesticides[second % max(n, 1)]
+    res['co_occurrence_count'] = count
+    res['samples_a'] = support[first]
+    res['samples_b'] = support[second]
+    if totals is not None:
+        if isinstance(totals, pd.Series):
+            index = pd.MultiIndex.from_frame(res[list(groups.columns)]) if len(groups.columns) > 1 else res[groups.columns[0]]
+            res['total_samples'] = totals.reindex(index).to_numpy()
+        else:
+            res['total_samples'] = totals
+        res['lift'] = (res['co_occurrence_count'] * res['total_samples'] / (res['samples_a'] * res['samples_b'])).round(4)
+    res['jaccard'] = (res['co_occurrence_count'] / (res['samples_a'] + res['samples_b'] - res['co_occurrence_count'])).round(4)
+    return res
+
+
+def _factorize(df: pd.DataFrame):
+    # group number of every row and the distinct key rows, in sorted order
+    groups = df.groupby(list(df.columns), observed=True, sort=True, dropna=False)
+    return groups.ngroup().to_numpy(dtype='int64'), groups.size().index.to_frame(index=False)
@@ -0,0 +1,90 @@
+import os
+import pandas as pd
+
+CELL_KEYS = ['product', 'programme', 'year', 'sampCountry', 'origCountry']
+MEASURES = {'samples': None, 'positive_samples': 'has_detection', 'val_samples': 'has_val'}
+PROGRAMMES = ['all', 'obligatory', 'voluntary']
+
+
+class SampleCube:
+    def __init__(self, cells: pd.DataFrame, duplicates: pd.DataFrame):
+        # sample counts per cell, programmes overlap (K018A is in both) and products are separate frames, so only year and countries add up
+        self.cells = cells
+        # fact rows of the few sample ids found in more than one cell, a roll-up subtracts their repeats to stay a distinct count
+        self.duplicates = duplicates
+
+    @classmethod
+    def build(cls, facts_by_product: dict):
+        cells, duplicates = [], []
+        for product, facts in facts_by_product.items():
+            facts = _plain(facts)
+            repeated = facts['sampleId'].duplicated(keep=False)
+            for programme in PROGRAMMES:
+                if programme == 'all':
+                    part = facts
+                elif programme in facts:
+                    part = facts[facts[programme]]
+                else:
+                    continue
+                part = part.assign(product=product, programme=programme)
+                cells.append(part.groupby(CELL_KEYS, dropna=False).agg(
+                    samples=('sampleId', 'size'),
+                    positive_samples=('has_detection', 'sum'),
+                    val_samples=('has_val', 'sum'),
+                ).reset_index())
+                duplicates.append(part[repeated.loc[part.index]][CELL_KEYS + ['sampleId', 'has_detection', 'has_val']])
+        duplicates = pd.concat(duplicates, ignore_index=True)
+        duplicates['sampleId'] = duplicates['sampleId'].astype(str)
+        return cls(pd.concat(cells, ignore_index=True), duplicates)
+
+    def slice(self, product: str = None, programme: str = None, year_list: list = None, country_list: list = None, country: str = 'sampCountry'):
+        def select(df):
+            mask = pd.Series(True, index=df.index)
+            if product is not None:
+                mask &= df['product'] == product
+            if programme is not None:
+                mask &= df['programme'] == programme
+            if year_list is not None:
+                mask &= df['year'].isin(year_list)
+            if country_list is not None:
+                mask &= df[country].isin(country_list)
+            return df[mask]
+        return SampleCube(select(self.cells), select(self.duplicates))
+
+    def rollup(self, keys: list = None):
+        # distinct sample counts per group of keys, all cells together without keys
+        keys = list(keys or [])
+        cells = self.cells if keys else self.cells.assign(total='total')
+        duplicates = self.duplicates if keys else self.duplicates.assign(total='total')
+        keys = keys or ['total']
+        res = cells.groupby(keys)[list(MEASURES)].sum()
+        for measure, flag in MEASURES.items():
+            rows = duplicates if flag is None else duplicates[duplicates[flag]]
+            grouped = rows.groupby(keys)['sampleId']
+            repeats = grouped.size() - grouped.nunique()
+            res[measure] -= repeats.reindex(res.index, fill_value=0)
+        return res.reset_index()
+
+    def counts(self, keys: list, product: str, programme: str = 'all', measure: str = 'samples', **filters):
+        # the same Series as groupby(keys)['sampleId'].nunique() over the matching samples
+        res = self.slice(product, programme, **filters).rollup(keys).set_index(keys)[measure]
+        return res[res > 0].astype('int64')
+
+    def save(self, path: str):
+        tmp_path = f'{path}.tmp'
+        pd.to_pickle({'cells': self.cells, 'duplicates': self.duplicates}, tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        data = pd.read_pickle(path)
+        return cls(data['cells'], data['duplicates'])
+
+
+def _plain(df: pd.DataFrame):
+    df = df.copy()
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+    df['year'] = df['year'].astype('int64')
+    return df
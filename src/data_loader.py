@@ -1,30 +1,286 @@
+import io
 import os
 import pandas as pd
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from src.instrument import note, traced
+from src.manifest import Manifest
+from src.prefilter import NEW_PATTERNS, OLD_PATTERNS, candidate_lines
+from src.schema import CompactSchema, align_categories
+from src.store import remove_partitions, write_partitions
+
+NEW_COLUMNS = ['sampId_A', 'sampMatCode.base.building', 'paramCode.base.param', 'origCountry', 'sampCountry', 'resType', 'resVal', 'progType']
+OLD_COLUMNS = ['LABSAMPCODE_A', 'SAMPCOUNTRY','ORIGCOUNTRY', 'PRODCODE', 'EFSAPRODCODE', 'PRODTREAT', 'PROGTYPE', 'PARAMCODE', 'RESVAL', 'FATPERC', 'RESTYPE']
+
+# every chunk is parsed with the same dtypes, the dtypes a full read infers from the whole file
+# (float64 for a text column without any value, object for every column of a file without rows)
+# are set once all chunks are read, see _as_full_read
+NEW_DTYPES = {'sampId_A': str, 'sampMatCode.base.building': str, 'paramCode.base.param': str, 'origCountry': str,
+              'sampCountry': str, 'resType': str, 'resVal': 'float64', 'progType': str}
+OLD_DTYPES = {'LABSAMPCODE_A': str, 'SAMPCOUNTRY': str, 'ORIGCOUNTRY': str, 'PRODCODE': str, 'EFSAPRODCODE': str, 'PRODTREAT': str,
+              'PROGTYPE': str, 'PARAMCODE': str, 'RESVAL': 'float64', 'FATPERC': 'float64', 'RESTYPE': str}
+
 class DataLoader:
-    def __init__(self, data_dir: str):
+    def __init__(self, data_dir: str, chunksize: int = None, compact: bool = False, prefilter: bool = False):
         self.data_dir = data_dir
+        # number of raw rows parsed at once in streaming mode, None reads the whole file
+        self.chunksize = chunksize
+        # store the code columns of the cleaned frames as categories
+        self.compact = compact
+        # scan the raw bytes for the product and programme codes and only parse the lines holding them
+        self.prefilter = prefilter
         
+    @traced('loader')
     def load_dataset_new(self, country: str, year: int, dest_dir: str, save: bool = True):
-        path = os.path.join(self.data_dir, f'MOPER_ALL_DATA_SSD2_{year}_{country}.csv')
-        df = pd.read_csv(path)
-        df_selected = df[['sampId_A', 'sampMatCode.base.building', 'paramCode.base.param', 'origCountry', 'sampCountry', 'resType', 'resVal', 'progType']]
-        df_filtered = df_selected[((df_selected['sampMatCode.base.building'] == 'A039C') | (df_selected['sampMatCode.base.building'].str.contains('A02L.*')))]
-        df_filtered = df_filtered[df_filtered['progType'].isin(['K005A', 'K009A', 'K018A'])]
-        df_renamed = df_filtered.rename(columns = {'sampMatCode.base.building' : 'productCode',
-                                                   'paramCode.base.param' : 'pesticideCode',
-                                                   'sampId_A' : 'sampleId'})
-        df_renamed.reset_index()
+        path = self._raw_path(country, year)
+        if self.prefilter:
+            df_renamed = self._read_prefiltered(path, NEW_COLUMNS, NEW_DTYPES, NEW_PATTERNS, self._clean_new)
+        elif self.chunksize is None:
+            df_renamed = self._clean_new(self._read_full(path))
+        else:
+            df_renamed = self._read_streaming(path, NEW_COLUMNS, NEW_DTYPES, self._clean_new)
+        if self.compact:
+            df_renamed = self._compact(df_renamed)
+        note(rows_out=len(df_renamed))
         
         if save:
             df_renamed.to_pickle(f'{dest_dir}/cleaned_{year}_{country}.pkl')
         else:
             return df_renamed
         
+    @traced('loader')
     def load_dataset_old(self, country: str, year: int, dest_dir: str, save: bool = True):
-        path = os.path.join(self.data_dir, f'MOPER_ALL_DATA_{year}_{country}.csv')
+        path = self._raw_path(country, year)
+        if self.prefilter:
+            df_renamed = self._read_prefiltered(path, OLD_COLUMNS, OLD_DTYPES, OLD_PATTERNS, self._clean_old)
+        elif self.chunksize is None:
+            df_renamed = self._clean_old(self._read_full(path))
+        else:
+            df_renamed = self._read_streaming(path, OLD_COLUMNS, OLD_DTYPES, self._clean_old)
+        if self.compact:
+            df_renamed = self._compact(df_renamed)
+        note(rows_out=len(df_renamed))
+        
+        if save:
+            df_renamed.to_pickle(f'{dest_dir}/cleaned_{year}_{country}.pkl')
+        else:
+            return df_renamed
+    
+    @traced('loader')
+    def load_all_datasets(self, country_list: list, year_list: list, exceptions_list: list[tuple], dest_dir: str, n_jobs: int = 1, manifest_path: str = None):
+        # with a manifest, raw files that did not change since their last load are skipped
+        manifest = Manifest(manifest_path) if manifest_path is not None else None
+        if n_jobs > 1:
+            return self._load_all_datasets_parallel(country_list, year_list, exceptions_list, dest_dir, n_jobs, manifest)
+        
+        for country in country_list:
+            for year in year_list:
+                if (country, year) not in exceptions_list and not self._is_loaded(manifest, country, year, dest_dir):
+                    self._load_dataset(country=country, year=year, dest_dir=dest_dir)
+                    self._record_loaded(manifest, country, year)
+            print(f'Loading data for {country} completed.')
+            
+    @traced('loader')
+    def concat_datasets(self, country_list: list, year_list: list, orig_dir: str, exceptions_list: list[tuple], dest_dir: str, manifest_path: str = None):
+        final_path = f'{dest_dir}/final_dataset.pkl'
+        partitions = [(year, country) for year in year_list for country in country_list if (country, year) not in exceptions_list]
+        
+        # with a manifest, unchanged partitions are sliced out of the previous final_dataset.pkl
+        # instead of being read again, the result is the same as a full rebuild
+        manifest = Manifest(manifest_path) if manifest_path is not None else None
+        previous = self._previous_partitions(manifest, final_path)
+        changed = {(year, country) for year, country in partitions
+                   if (year, country) not in previous or not manifest.is_current(f'cleaned/{country}_{year}', f'{orig_dir}/cleaned_{year}_{country}.pkl')}
+        if manifest is not None and not changed and list(previous) == partitions:
+            print('All datasets are up to date.')
+            return
+        
+        final_df = pd.read_pickle(final_path) if previous else None
+        all_dfs = []
+        rows_list = []
+        # consecutive unchanged partitions are taken as one slice, so the concat stays cheap
+        run_start, run_end = None, None
+        for year, country in partitions:
+            if (year, country) in changed:
+                if run_start is not None:
+                    all_dfs.append(final_df.iloc[run_start:run_end])
+                    run_start, run_end = None, None
+                df = pd.read_pickle(f'{orig_dir}/cleaned_{year}_{country}.pkl')
+                df['year'] = year
+                all_dfs.append(df)
+                rows_list.append(len(df))
+            else:
+                offset, rows = previous[(year, country)]
+                if run_start is None or offset != run_end:
+                    if run_start is not None:
+                        all_dfs.append(final_df.iloc[run_start:run_end])
+                    run_start = offset
+                run_end = offset + rows
+                rows_list.append(rows)
+        if run_start is not None:
+            all_dfs.append(final_df.iloc[run_start:run_end])
+        
+        final_df = pd.concat(align_categories(all_dfs), ignore_index=True)
+        note(rows_in=sum(rows_list), rows_out=len(final_df))
+        final_df.to_pickle(final_path)
+        if manifest is not None:
+            for year, country in changed:
+                manifest.record(f'cleaned/{country}_{year}', f'{orig_dir}/cleaned_{year}_{country}.pkl')
+            manifest.record('final', final_path, partitions=[[year, country, rows] for (year, country), rows in zip(partitions, rows_list)])
+            manifest.save()
+            print(f'{len(changed)} of {len(partitions)} datasets updated.')
+        print('All datasets concatenated and saved.')
+    
+    @traced('loader')
+    def write_store(self, country_list: list, year_list: list, orig_dir: str, exceptions_list: list[tuple], dest_dir: str, manifest_path: str = None):
+        # row ids follow the concat_datasets order, so reading the store back gives final_dataset.pkl row for row.
+        # with a manifest, sources whose cleaned file and first row id did not change keep their partition files,
+        # so appending a year only writes that year (and the partial aggregates of chunked mode only read it again)
+        manifest = Manifest(manifest_path) if manifest_path is not None else None
+        row_id = 0
+        written = 0
+        sources = set()
+        for year in year_list:
+            for country in country_list:
+                if (country, year) not in exceptions_list:
+                    path = f'{orig_dir}/cleaned_{year}_{country}.pkl'
+                    key = f'store/{country}_{year}'
+                    sources.add(key)
+                    entry = manifest.get(key) if manifest is not None else None
+                    if entry is not None and entry['first_row_id'] == row_id and manifest.is_current(key, path):
+                        row_id += entry['rows']
+                        continue
+                    df = pd.read_pickle(path)
+                    remove_partitions(dest_dir, year, country)
+                    write_partitions(df, dest_dir, year=year, source=country, first_row_id=row_id)
+                    if manifest is not None:
+                        manifest.record(key, path, first_row_id=row_id, rows=len(df))
+                    row_id += len(df)
+                    written += len(df)
+        if manifest is not None:
+            # sources written before that are not in the store any more
+            for key in [key for key in manifest.entries if key.startswith('store/') and key not in sources]:
+                country, year = key[len('store/'):].rsplit('_', 1)
+                remove_partitions(dest_dir, int(year), country)
+                manifest.remove(key)
+            manifest.save()
+        note(rows_in=written, rows_out=written)
+        print('All datasets written to the partitioned store.')
+    
+    def _load_all_datasets_parallel(self, country_list: list, year_list: list, exceptions_list: list[tuple], dest_dir: str, n_jobs: int, manifest: Manifest = None):
+        jobs = [(country, year) for country in country_list for year in year_list
+                if (country, year) not in exceptions_list and not self._is_loaded(manifest, country, year, dest_dir)]
+        # biggest files first, so a large country-year does not start last and keep one worker busy alone
+        jobs.sort(key=lambda job: self._raw_size(*job), reverse=True)
+        
+        errors = []
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(self._load_dataset, country, year, dest_dir): (country, year) for country, year in jobs}
+            for future in as_completed(futures):
+                country, year = futures[future]
+                try:
+                    future.result()
+                    self._record_loaded(manifest, country, year)
+                except Exception as e:
+                    errors.append((country, year, repr(e)))
+        
+        print(f'Loaded {len(jobs) - len(errors)} of {len(jobs)} datasets using {n_jobs} workers.')
+        for country, year, error in sorted(errors):
+            print(f'Loading data for {country} {year} failed: {error}')
+        return errors
+    
+    def _is_loaded(self, manifest: Manifest, country: str, year: int, dest_dir: str):
+        if manifest is None:
+            return False
+        return manifest.is_current(f'raw/{country}_{year}', self._raw_path(country, year)) and os.path.exists(f'{dest_dir}/cleaned_{year}_{country}.pkl')
+    
+    def _record_loaded(self, manifest: Manifest, country: str, year: int):
+        if manifest is not None:
+            manifest.record(f'raw/{country}_{year}', self._raw_path(country, year))
+            manifest.save()
+    
+    def _previous_partitions(self, manifest: Manifest, final_path: str):
+        if manifest is None or not manifest.is_current('final', final_path):
+            return {}
+        previous = {}
+        offset = 0
+        for year, country, rows in manifest.get('final')['partitions']:
+            previous[(year, country)] = (offset, rows)
+            offset += rows
+        return previous
+    
+    def _load_dataset(self, country: str, year: int, dest_dir: str):
+        if year <= 2018:
+            self.load_dataset_old(country=country, year=year, dest_dir=dest_dir)
+        else:
+            self.load_dataset_new(country=country, year=year, dest_dir=dest_dir)
+    
+    def _raw_path(self, country: str, year: int):
+        if year <= 2018:
+            return os.path.join(self.data_dir, f'MOPER_ALL_DATA_{year}_{country}.csv')
+        return os.path.join(self.data_dir, f'MOPER_ALL_DATA_SSD2_{year}_{country}.csv')
+    
+    def _raw_size(self, country: str, year: int):
+        path = self._raw_path(country, year)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    
+    def _compact(self, df: pd.DataFrame):
+        # sample ids are interned and resVal downcast only when the whole dataset is loaded,
+        # the cleaned files keep exact values and the original ids
+        return CompactSchema().fit(df).compact(df, intern_samples=False, downcast=False)
+    
+    def _read_full(self, path: str):
         df = pd.read_csv(path)
-        df_selected = df[['LABSAMPCODE_A', 'SAMPCOUNTRY','ORIGCOUNTRY', 'PRODCODE', 'EFSAPRODCODE', 'PRODTREAT', 'PROGTYPE', 'PARAMCODE', 'RESVAL', 'FATPERC', 'RESTYPE']]
+        note(rows_in=len(df))
+        return df
+    
+    def _read_streaming(self, path: str, columns: list, dtypes: dict, clean):
+        # only the needed columns are parsed and every chunk is filtered before the next one is read,
+        # so peak memory is bounded by chunksize rather than by the size of the file
+        parts = []
+        rows_in = 0
+        filled = set()
+        with pd.read_csv(path, usecols=columns, dtype=dtypes, chunksize=self.chunksize) as reader:
+            for chunk in reader:
+                rows_in += len(chunk)
+                filled.update(chunk.columns[chunk.notna().any().to_numpy()])
+                parts.append(clean(chunk))
+        note(rows_in=rows_in)
+        return self._as_full_read(pd.concat(parts), columns, dtypes, filled, rows_in)
+    
+    def _read_prefiltered(self, path: str, columns: list, dtypes: dict, patterns: list, clean):
+        # only the header and the lines holding the codes the clean filter keeps are parsed, with the index
+        # a full read gives them. the values are the same as the full read, the dtypes are taken from the parsed lines:
+        # a text column without a value in them is float64 even when other lines of the file fill it (object in the
+        # full read), with no line parsed the text columns stay object even when the file has no value in them
+        data, index, rows_in = candidate_lines(path, patterns)
+        note(rows_in=rows_in)
+        if not data:
+            return clean(pd.read_csv(path, usecols=columns, dtype=dtypes))
+        df = pd.read_csv(io.BytesIO(data), usecols=columns, dtype=dtypes)
+        df.index = index
+        filled = set(df.columns[df.notna().any().to_numpy()]) if len(df) else set(columns)
+        return self._as_full_read(clean(df), columns, dtypes, filled, rows_in)
+    
+    def _as_full_read(self, df: pd.DataFrame, columns: list, dtypes: dict, filled: set, rows_in: int):
+        # the dtypes pd.read_csv infers from the whole file: object for every column of a file without rows,
+        # float64 for a text column without a value in any row. the cleaned columns are columns renamed, in order
+        if rows_in == 0:
+            return df.astype(object)
+        empty = [name for column, name in zip(columns, df.columns) if dtypes[column] is str and column not in filled]
+        return df.astype({name: 'float64' for name in empty})
+    
+    def _clean_new(self, df: pd.DataFrame):
+        df_selected = df[NEW_COLUMNS]
+        df_filtered = df_selected[((df_selected['sampMatCode.base.building'] == 'A039C') | (df_selected['sampMatCode.base.building'].str.contains('A02L.*')))]
+        df_filtered = df_filtered[df_filtered['progType'].isin(['K005A', 'K009A', 'K018A'])]
+        df_renamed = df_filtered.rename(columns = {'sampMatCode.base.building' : 'productCode',
+                                                   'paramCode.base.param' : 'pesticideCode',
+                                                   'sampId_A' : 'sampleId'})
+        return df_renamed
+    
+    def _clean_old(self, df: pd.DataFrame):
+        df_selected = df[OLD_COLUMNS]
         df_filtered = df_selected[df_selected['PRODCODE'].isin(['P1020000A', 'P1020010A'])]
         df_filtered = df_filtered[df_filtered['PROGTYPE'].isin(['K005A', 'K009A', 'K018A'])]
         df_filtered = df_filtered[df_filtered['PRODTREAT'].isin(['T134A', 'T150A', 'T152A', 'T999A'])]
@@ -40,33 +296,4 @@ class DataLoader:
                                                    'FATPERC' : 'fatPerc', 
                                                    'RESTYPE' : 'resType'
         })
-        
-        df_renamed.reset_index()
-        
-        if save:
-            df_renamed.to_pickle(f'{dest_dir}/cleaned_{year}_{country}.pkl')
-        else:
-            return df_renamed
-    
-    def load_all_datasets(self, country_list: list, year_list: list, exceptions_list: list[tuple], dest_dir: str):
-        for country in country_list:
-            for year in year_list:
-                if year <= 2018:
-                    if (country, year) not in exceptions_list:
-                        self.load_dataset_old(country=country, year=year, dest_dir=dest_dir)
-                else:
-                    if (country, year) not in exceptions_list:
-                        self.load_dataset_new(country=country, year=year, dest_dir=dest_dir)
-            print(f'Loading data for {country} completed.')
-            
-    def concat_datasets(self, country_list: list, year_list: list, orig_dir: str, exceptions_list: list[tuple], dest_dir: str):
-        all_dfs = []
-        for year in year_list:
-            for country in country_list:
-                if (country, year) not in exceptions_list:
-                    df = pd.read_pickle(f'{orig_dir}/cleaned_{year}_{country}.pkl')
-                    df['year'] = year
-                    all_dfs.append(df)
-        final_df = pd.concat(all_dfs, ignore_index=True)
-        final_df.to_pickle(f'{dest_dir}/final_dataset.pkl')
-        print('All datasets concatenated and saved.')
\ No newline at end of file
+        return df_renamed
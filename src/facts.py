@@ -0,0 +1,84 @@
+import hashlib
+import os
+import pandas as pd
+
+# one fact row per sample and grouping attributes, a sample id only repeats if its residue rows disagree on them
+FACT_KEYS = ['sampleId', 'sampCountry', 'origCountry', 'year', 'progType']
+
+
+def build_facts(df: pd.DataFrame, obligatory_year_list: list = None):
+    detected = df['resVal'].notna()
+    rows = df[FACT_KEYS].copy()
+    rows['has_detection'] = detected
+    rows['has_val'] = df['resType'] == 'VAL'
+    # same as counting pesticideCode over the detected rows
+    rows['n_detected'] = detected & df['pesticideCode'].notna()
+
+    facts = rows.groupby(FACT_KEYS, observed=True, dropna=False, sort=False).agg(
+        has_detection=('has_detection', 'any'),
+        has_val=('has_val', 'any'),
+        n_detected=('n_detected', 'sum'),
+    ).reset_index()
+    facts['n_detected'] = facts['n_detected'].astype('int64')
+    return programme_flags(mark_unique(facts), obligatory_year_list)
+
+
+def programme_flags(facts: pd.DataFrame, obligatory_year_list: list = None):
+    # the programme split used for the obligatory/voluntary masks of DataAggregator, a function of year and progType only,
+    # so it is set again on stored facts when the obligatory years change
+    if obligatory_year_list is not None:
+        obligatory_year = facts['year'].isin(obligatory_year_list)
+        facts['obligatory'] = obligatory_year & facts['progType'].isin(['K009A', 'K018A'])
+        facts['voluntary'] = ~obligatory_year | facts['progType'].isin(['K005A', 'K018A'])
+    return facts
+
+
+def merge_facts(parts: list):
+    # fact tables of disjoint row sets, a sample whose rows were split between them is merged back into one fact row
+    facts = pd.concat(parts, ignore_index=True)
+    if facts.duplicated(FACT_KEYS).any():
+        flags = {col: (col, 'first') for col in ['obligatory', 'voluntary'] if col in facts}
+        facts = facts.groupby(FACT_KEYS, observed=True, dropna=False, sort=False).agg(
+            has_detection=('has_detection', 'any'),
+            has_val=('has_val', 'any'),
+            n_detected=('n_detected', 'sum'),
+            **flags,
+        ).reset_index()
+    return mark_unique(facts)
+
+
+def mark_unique(facts: pd.DataFrame):
+    # with unique sample ids a distinct count is a plain row count, filtered copies keep this flag
+    facts.attrs['unique_samples'] = bool(facts['sampleId'].is_unique)
+    return facts
+
+
+def count_samples(df: pd.DataFrame, keys: list):
+    if df.attrs.get('unique_samples', False):
+        return df.groupby(keys, observed=True).size()
+    return df.groupby(keys, observed=True)['sampleId'].nunique()
+
+
+def pesticides_per_sample(df: pd.DataFrame, keys: list):
+    detected = df[df['has_detection']]
+    if detected.attrs.get('unique_samples', False):
+        return detected.set_index(keys + ['sampleId'])['n_detected'].sort_index()
+    return detected.groupby(keys + ['sampleId'], observed=True)['n_detected'].sum()
+
+
+def save_facts(facts: pd.DataFrame, path: str):
+    tmp_path = f'{path}.tmp'
+    facts.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def load_facts(path: str):
+    return mark_unique(pd.read_parquet(path))
+
+
+def source_key(*parts):
+    # identifies the input a fact table was built from, any change gives a new file name
+    digest = hashlib.blake2b(digest_size=8)
+    for part in parts:
+        digest.update(repr(part).encode())
+    return digest.hexdigest()
@@ -0,0 +1,129 @@
+import functools
+import inspect
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+import psutil
+
+# PIPELINE_TRACE=<file> appends one json line per traced call to <file>, '-' writes to stderr.
+# PIPELINE_TRACE_ALLOC=1 adds the tracemalloc peak of every call, which slows python heavy code down.
+# Both are read once at import, when PIPELINE_TRACE is unset the decorated functions are returned unchanged.
+TRACE_PATH = os.environ.get('PIPELINE_TRACE') or None
+TRACE_ALLOC = TRACE_PATH is not None and os.environ.get('PIPELINE_TRACE_ALLOC', '') not in ('', '0')
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def traced(stage: str, rows_in=None):
+    # rows_in(arguments) gives the input rows of a call once it returned, arguments are the bound call arguments
+    def decorator(fn):
+        if TRACE_PATH is None:
+            return fn
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            span = _start(stage, fn.__name__, arguments.arguments)
+            error = None
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                if error is None:
+                    if span['rows_out'] is None and hasattr(result, 'shape'):
+                        span['rows_out'] = int(result.shape[0])
+                    if span['rows_in'] is None and rows_in is not None:
+                        span['rows_in'] = rows_in(arguments.arguments)
+                _finish(span, error)
+            return result
+        return wrapper
+    return decorator
+
+
+def note(**fields):
+    # adds fields such as rows_in and rows_out to the innermost traced call of this thread
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1].update(fields)
+
+
+def describe(arguments: dict):
+    # lists by their length, frames by their rows, plain values as they are
+    params = {}
+    for key, value in arguments.items():
+        if key == 'self':
+            continue
+        if isinstance(value, (list, tuple, set)):
+            params[f'{key}_size'] = len(value)
+        elif hasattr(value, 'shape'):
+            params[f'{key}_rows'] = int(value.shape[0])
+        elif value is None or isinstance(value, (str, int, float, bool)):
+            params[key] = value
+    return params
+
+
+def _start(stage: str, name: str, arguments: dict):
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    span = {'stage': stage, 'name': name, 'params': describe(arguments), 'rows_in': None, 'rows_out': None,
+            'depth': len(stack), 'parent': stack[-1]['name'] if stack else None, 'rss_start': _rss()}
+    if TRACE_ALLOC:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        current, peak = tracemalloc.get_traced_memory()
+        # an outer call keeps the peak reached before this one started
+        if stack:
+            stack[-1]['alloc_peak'] = max(stack[-1]['alloc_peak'], peak)
+        tracemalloc.reset_peak()
+        span['alloc_start'] = current
+        span['alloc_peak'] = current
+    stack.append(span)
+    span['start'] = time.perf_counter()
+    return span
+
+
+def _finish(span: dict, error: BaseException = None):
+    seconds = time.perf_counter() - span.pop('start')
+    stack = _local.stack
+    stack.pop()
+    record = {'ts': time.time(), 'pid': os.getpid(), 'thread': threading.current_thread().name, 'seconds': round(seconds, 6),
+              'status': 'ok' if error is None else type(error).__name__}
+    rss_start = span.pop('rss_start')
+    rss = _rss()
+    record.update(span)
+    record['rss_mb'] = round(rss / 2**20, 2)
+    record['rss_delta_mb'] = round((rss - rss_start) / 2**20, 2)
+    # high watermark of the whole process, a call that raised it is the one that set the peak
+    record['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, 2)
+    if TRACE_ALLOC:
+        # with several threads the allocations of calls running side by side are mixed
+        peak = max(record.pop('alloc_peak'), tracemalloc.get_traced_memory()[1])
+        record['alloc_peak_mb'] = round((peak - record.pop('alloc_start')) / 2**20, 2)
+        if stack:
+            stack[-1]['alloc_peak'] = max(stack[-1]['alloc_peak'], peak)
+    _write(record)
+
+
+def _rss():
+    return psutil.Process().memory_info().rss
+
+
+def _write(record: dict):
+    line = json.dumps(record, default=str) + '\n'
+    with _write_lock:
+        if TRACE_PATH == '-':
+            os.write(2, line.encode())
+        else:
+            # opened per record in append mode, so worker processes can share the file
+            with open(TRACE_PATH, 'a') as f:
+                f.write(line)
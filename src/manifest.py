@@ -0,0 +1,51 @@
+import hashlib
+import json
+import os
+
+
+class Manifest:
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def is_current(self, key: str, file_path: str):
+        entry = self.entries.get(key)
+        if entry is None or not os.path.exists(file_path):
+            return False
+        stat = os.stat(file_path)
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime == entry['mtime']:
+            return True
+        # touched but maybe not changed, the content hash decides
+        if file_hash(file_path) != entry['hash']:
+            return False
+        entry['mtime'] = stat.st_mtime
+        return True
+
+    def record(self, key: str, file_path: str, **extra):
+        stat = os.stat(file_path)
+        self.entries[key] = {'path': file_path, 'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': file_hash(file_path), **extra}
+
+    def get(self, key: str):
+        return self.entries.get(key)
+
+    def remove(self, key: str):
+        self.entries.pop(key, None)
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def file_hash(path: str, block_size: int = 2**20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
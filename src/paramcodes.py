@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['name', 'full_name', 'code', 'limit']
+
+
+class PesticideRegistry:
+    def __init__(self, path: str):
+        self.path = path
+        self.signature = file_signature(path)
+        self.frame = parse_paramcodes(path)
+
+        # pesticide id = position in codes, the aligned arrays below are indexed by it
+        # duplicated codes (only the unparsed ' ' placeholders) keep their first row, they never match data
+        first = ~self.frame['code'].duplicated()
+        self.codes = pd.Index(self.frame.loc[first, 'code'])
+        # one extra NaN slot at the end for codes missing from the file
+        self.names = np.append(self.frame.loc[first, 'name'].to_numpy(dtype=object), np.nan)
+        self.full_names = np.append(self.frame.loc[first, 'full_name'].to_numpy(dtype=object), np.nan)
+        self.code_values = np.append(self.codes.to_numpy(dtype=object), np.nan)
+        self.limits = np.append(self.frame.loc[first, 'limit'].to_numpy(dtype='float64'), np.nan)
+
+    def ids(self, codes: pd.Series):
+        # -1 for codes that are not in the file
+        if isinstance(codes.dtype, pd.CategoricalDtype):
+            category_ids = self.codes.get_indexer(codes.cat.categories)
+            return np.where(codes.cat.codes.to_numpy() < 0, -1, category_ids[codes.cat.codes.to_numpy()])
+        return self.codes.get_indexer(codes)
+
+    def join(self, df: pd.DataFrame, on: str = 'pesticideCode', how: str = 'inner'):
+        # same result as pd.merge(df, paramcodes, left_on=on, right_on='code', how=how)
+        ids = self.ids(df[on])
+        if how == 'inner':
+            found = ids >= 0
+            df = df[found]
+            ids = ids[found]
+        res = df.reset_index(drop=True)
+        res['name'] = self.names[ids]
+        res['full_name'] = self.full_names[ids]
+        res['code'] = self.code_values[ids]
+        res['limit'] = self.limits[ids]
+        return res
+
+
+_registries = {}
+
+
+def get_registry(path: str):
+    # parsed once per process and parsed again only when the file changes
+    key = os.path.abspath(path)
+    registry = _registries.get(key)
+    if registry is None or registry.signature != file_signature(path):
+        registry = PesticideRegistry(path)
+        _registries[key] = registry
+    return registry
+
+
+def file_signature(path: str):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def parse_paramcodes(path: str):
+    paramcodes = pd.read_csv(path)
+    paramcodes = paramcodes.rename(columns={"SKRÓT [EN]" : "name",
+                                            "PEŁNA NAZWA [EN]" : "full_name",
+                                            "PARAMCODE : WARTOŚĆ" : "paramcode_limit"})
+    paramcodes[['code', 'limit']] = paramcodes['paramcode_limit'].str.extract(r'“?([^”"]+)”?\s*:\s*([^\s]+)')
+    paramcodes['limit'] = pd.to_numeric(paramcodes['limit'], errors='coerce').fillna(float('inf'))
+    return paramcodes[COLUMNS]
@@ -0,0 +1,67 @@
+import mmap
+import os
+
+import numpy as np
+
+# byte patterns every kept row of a raw file holds somewhere in its line, the first one (the product codes) is searched
+# through the whole file, the others are only checked on the lines it found. the exact column filters of
+# DataLoader._clean_new / _clean_old still run on the parsed rows, the patterns only have to keep all of them
+NEW_PATTERNS = [[b'A039C', b'A02L'], [b'K005A', b'K009A', b'K018A']]
+OLD_PATTERNS = [[b'P1020000A', b'P1020010A'], [b'K005A', b'K009A', b'K018A'], [b'T134A', b'T150A', b'T152A', b'T999A']]
+
+# bytes of the file looked at at once when finding the line ends
+BLOCK_SIZE = 64 * 1024 * 1024
+
+
+def candidate_lines(path: str, patterns: list):
+    # the header and every line holding one of the codes of each pattern group, as csv bytes, with the record number
+    # of each kept line (the index a full pd.read_csv gives that row) and the number of records in the file
+    if os.path.getsize(path) == 0:
+        return b'', np.array([], dtype='int64'), 0
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        ends = _record_ends(mm)
+        starts = np.r_[0, ends[:-1] + 1]
+
+        hits = []
+        for code in patterns[0]:
+            pos = mm.find(code)
+            while pos != -1:
+                hits.append(pos)
+                # one hit per line is enough
+                pos = mm.find(code, int(ends[np.searchsorted(ends, pos)]) + 1)
+        lines = np.unique(np.searchsorted(ends, np.array(hits, dtype='int64')))
+        lines = lines[lines > 0]
+
+        kept, chunks = [], [mm[starts[0]:ends[0] + 1]]
+        for line in lines:
+            data = mm[starts[line]:ends[line] + 1]
+            if all(any(code in data for code in group) for group in patterns[1:]):
+                kept.append(line)
+                chunks.append(data)
+        # pandas skips blank lines and does not number them
+        blank = ends == starts
+        for line in np.flatnonzero(ends - starts == 1):
+            blank[line] = mm[starts[line]] == 13
+        record = np.cumsum(~blank) - 2
+        rows = int(record[-1]) + 1 if len(record) else 0
+        return b''.join(chunks), record[np.array(kept, dtype='int64')], rows
+
+
+def _record_ends(mm: mmap.mmap):
+    # position of the newline closing every record, newlines inside quoted fields do not end one,
+    # the last record may end at the end of the file without a newline
+    ends = []
+    quotes_before = 0
+    for start in range(0, len(mm), BLOCK_SIZE):
+        block = np.frombuffer(mm, dtype=np.uint8, count=min(BLOCK_SIZE, len(mm) - start), offset=start)
+        newlines = np.flatnonzero(block == 10)
+        quotes = np.flatnonzero(block == 34)
+        if len(quotes):
+            newlines = newlines[(quotes_before + np.searchsorted(quotes, newlines)) % 2 == 0]
+        quotes_before += len(quotes)
+        ends.append(newlines + start)
+        del block
+    ends = np.concatenate(ends)
+    if not len(ends) or ends[-1] != len(mm) - 1:
+        ends = np.r_[ends, len(mm)]
+    return ends
@@ -0,0 +1,99 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+# figure kind -> function of src.visualization building it, maps are plotly figures, the others matplotlib
+FIGURES = {'map': 'map_figure', 'chord': 'chord_figure', 'stats_heatmap': 'stats_heatmap_figure'}
+FORMATS = ['png', 'svg', 'html']
+
+
+def poster_plan(poster_dir: str, fmt: str = 'png'):
+    # the maps and the chord diagram of the poster, from the data files kept next to them
+    maps = pd.read_csv(os.path.join(poster_dir, '1_map_data.csv'))
+    chord = pd.read_csv(os.path.join(poster_dir, '2_chord_data.csv'))
+    countries = maps['sampCountry'].tolist()
+    obligatory = maps['obligaotry_samples'].fillna(0)
+    voluntary = maps['voluntary_samples'].fillna(0)
+    scale = ['#FDE2F3', '#5A189A']
+    # the chord diagram is a matplotlib figure, it has no html version
+    chord_fmt = 'png' if fmt == 'html' else fmt
+    return [
+        (f'1_map_both.{fmt}', 'map', dict(country_codes_list=countries, values_list=(obligatory + voluntary).tolist(), title='Milk samples, 2011–2023',
+                                          legend_label='Samples', custom_color_scale=scale, text_list=(obligatory + voluntary).astype(int).tolist())),
+        (f'1_map_mandatory.{fmt}', 'map', dict(country_codes_list=countries, values_list=obligatory.tolist(), title='Milk samples in the mandatory programme, 2011–2023',
+                                               legend_label='Samples', custom_color_scale=scale, text_list=obligatory.astype(int).tolist())),
+        (f'1_map_voluntary.{fmt}', 'map', dict(country_codes_list=countries, values_list=voluntary.tolist(), title='Milk samples in the voluntary programme, 2011–2023',
+                                               legend_label='Samples', custom_color_scale=scale, text_list=voluntary.astype(int).tolist())),
+        (f'2_chord.{chord_fmt}', 'chord', dict(df=chord, product='milk', country_type='reporting', title='Pesticide residues detected in milk per reporting country')),
+    ]
+
+
+def render_figures(specs: list, out_dir: str, n_jobs: int = 1):
+    # specs are (file name, kind, kwargs), the extension of the file name picks the format,
+    # every figure is built and written headless in its own worker
+    os.makedirs(out_dir, exist_ok=True)
+    errors = []
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_headless) as executor:
+            futures = {executor.submit(render_figure, spec, out_dir): spec[0] for spec in specs}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append((futures[future], repr(e)))
+    else:
+        _headless()
+        for spec in specs:
+            try:
+                render_figure(spec, out_dir)
+            except Exception as e:
+                errors.append((spec[0], repr(e)))
+
+    print(f'Rendered {len(specs) - len(errors)} of {len(specs)} figures to {out_dir}.')
+    for name, error in sorted(errors):
+        print(f'Figure {name} failed: {error}')
+    return errors
+
+
+def render_figure(spec: tuple, out_dir: str):
+    from src import visualization
+    name, kind, kwargs = spec
+    fmt = name.rsplit('.', 1)[-1]
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown figure format {fmt}, use one of {FORMATS}.')
+    path = os.path.join(out_dir, name)
+    fig = getattr(visualization, FIGURES[kind])(**kwargs)
+    if fig is None:
+        raise ValueError(f'Figure {name} has nothing to draw.')
+    if kind == 'map':
+        # static images go through kaleido
+        if fmt == 'html':
+            fig.write_html(path)
+        else:
+            fig.write_image(path, format=fmt, width=1000, height=700)
+    else:
+        import matplotlib.pyplot as plt
+        if fmt == 'html':
+            raise ValueError(f'{kind} figures are matplotlib figures, use png or svg.')
+        fig.savefig(path, format=fmt, bbox_inches='tight')
+        plt.close(fig)
+    return path
+
+
+def _headless():
+    # no display in the workers, set before pyplot is imported there
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the poster figures headless, in parallel.')
+    parser.add_argument('--poster-dir', default='poster')
+    parser.add_argument('--out-dir', default='plots/poster')
+    parser.add_argument('--format', default='png', choices=FORMATS)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    render_figures(poster_plan(args.poster_dir, args.format), args.out_dir, args.jobs)
@@ -0,0 +1,142 @@
+import argparse
+import fnmatch
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from src.aggregator import DataAggregator
+
+COUNTRY_LIST = ["AT", "CY", "CZ", "DE", "DK", "ES", "FR", "GR", "IE", "LU",
+                "LV", "MT", "NO", "PL", "RO", "SE", "SI", "SK", "IT", "NL", "FI"]
+NEW_COUNTRY_LIST = ["BE", "BA", "BG", "HR", "EE", "HU", "PT", "GB", "LT", "IS", "ME", "XI", "MK"]
+FULL_COUNTRY_LIST = COUNTRY_LIST + NEW_COUNTRY_LIST
+YEAR_LIST = list(range(2011, 2024))
+
+# frames and programme masks read by the jobs of one product, released after its last group
+PRODUCT_FRAMES = {'milk': ['milk_dataframe', 'milk_obligatory_mask', 'milk_voluntary_mask'],
+                  'butter': ['butter_dataframe', 'butter_obligatory_mask', 'butter_voluntary_mask'],
+                  'both': ['dataframe']}
+# filters a method applies that its arguments do not name
+METHOD_FILTERS = {'country_pesticides': {'country': 'origCountry'},
+                  'country_pesticide_relation': {'country': 'origCountry'},
+                  'voluntary_programmes_ranking': {'programme': 'voluntary'},
+                  'voluntary_sampling_stats': {'programme': 'voluntary'}}
+
+
+def report_plan(paramcodes_path: str):
+    # every csv of results/results written straight from a DataAggregator method,
+    # 1_samples_count_*, 2_1_mean_*, 2_4_*_no_modified and 10_* are edited afterwards (see analysis/add_report_data_1.py) and are not in the plan
+    # arguments as used for the published tables, top_k=100 keeps every pesticide. known differences:
+    # 2_2_f / 2_2_l (butter, all programmes) were computed from the butter rows, country_year_pesticide_list_obligatory reads
+    # the rows of both products there and gives more rows. 2_4_acceptable_limits_overun_* list every sample over its limit
+    # and follow the merged data exactly, e.g. more BE 2011 rows than data/cleaned/cleaned_2011_BE.pkl holds give more rows
+    full = dict(year_list=YEAR_LIST, country_list=FULL_COUNTRY_LIST)
+    plan = []
+    for product in ['milk', 'butter']:
+        heatmap_top_k = {'milk': 2, 'butter': 5}[product]
+        plan += [
+            (f'2_1_samples_count_voluntary_{product}.csv', 'count_obligatory_voluntary_samples', dict(full, product=product)),
+            (f'2_3_samples_pesticides_percentage_{product}.csv', 'percentage_with_pesticides', dict(year_list=YEAR_LIST, country_list=COUNTRY_LIST, product=product)),
+            (f'2_4_acceptable_limits_overun_{product}.csv', 'percentage_with_pesticides_limits', dict(full, product=product, limits_path=paramcodes_path, sample_id=True)),
+            (f'2_5_pesticides_countries_heatmap_{product}_o.csv', 'country_pesticides', dict(full, paramcodes_path=paramcodes_path, product=product, programme='obligatory', top_k=heatmap_top_k)),
+            (f'2_5_pesticides_countries_heatmap_{product}_no.csv', 'country_pesticides', dict(full, paramcodes_path=paramcodes_path, product=product, programme='voluntary', top_k=heatmap_top_k)),
+            (f'3_samples_detected_relation_{product}.csv', 'pesticides_sampling_relation', dict(year_list=YEAR_LIST, country_list=COUNTRY_LIST, product=product, programme='obligatory')),
+            (f'3_samples_detected_relation_{product}_no.csv', 'pesticides_sampling_relation', dict(year_list=YEAR_LIST, country_list=COUNTRY_LIST, product=product, programme='voluntary')),
+            (f'5_top_detected_pesticides_{product}.csv', 'count_detected_pesticides', dict(full, product=product)),
+            (f'5_top_pesticides_year_{product}.csv', 'yearly_top_pesticides', dict(full, product=product, top_k={'milk': 9, 'butter': 10}[product])),
+            (f'7_country_pesticide_relation_origin_{product}_o.csv', 'country_pesticide_relation', dict(full, product=product, paramcodes_path=paramcodes_path, programme='obligatory', top_k=10)),
+            (f'7_country_pesticide_relation_origin_{product}_no.csv', 'country_pesticide_relation', dict(full, product=product, paramcodes_path=paramcodes_path, programme='voluntary')),
+            (f'8_voluntary_detection_ranking_{product}.csv', 'voluntary_programmes_ranking', dict(full, product=product, country_type='origin')),
+            (f'8_voluntary_sampling_stats_{product}.csv', 'voluntary_sampling_stats', dict(full, product=product, country_type='reporting', limits_path=paramcodes_path)),
+            (f'8_voluntary_sampling_stats_origin_{product}.csv', 'voluntary_sampling_stats', dict(full, product=product, country_type='origin', limits_path=paramcodes_path)),
+        ]
+    for letter, (product, programme, country) in zip('abcdefghijkl', [(p, prog, c) for c in ['sampCountry', 'origCountry'] for p in ['milk', 'butter'] for prog in ['obligatory', 'voluntary', 'both']]):
+        suffix = {'obligatory': 'o', 'voluntary': 'no', 'both': 'all_programmes'}[programme]
+        origin = '_origin' if country == 'origCountry' else ''
+        plan.append((f'2_2_{letter}_top_detected_pests{origin}_{product}_{suffix}.csv', 'country_year_pesticide_list_obligatory',
+                     dict(full, paramcodes_path=paramcodes_path, product=product, programme=programme, country=country, top_k=10 if programme == 'obligatory' else 100)))
+    plan += [
+        # both programmes of butter
+        ('2_pesticides_countries_heatmap_both.csv', 'country_pesticides', dict(full, paramcodes_path=paramcodes_path, product='butter', programme='both', top_k=5)),
+        ('3_samples_detected_relation.csv', 'pesticides_sampling_relation', dict(year_list=YEAR_LIST, country_list=COUNTRY_LIST, product='both', programme='both')),
+        ('7_country_pesticide_relation_origin.csv', 'country_pesticide_relation', dict(full, product='both', paramcodes_path=paramcodes_path)),
+    ]
+    return plan
+
+
+def filter_key(method: str, kwargs: dict):
+    # product, programme, years, countries and country axis of the rows a job reads
+    filters = {'product': kwargs.get('product', 'both'), 'programme': kwargs.get('programme', 'all'),
+               'country': 'origCountry' if kwargs.get('country_type') == 'origin' else kwargs.get('country', 'sampCountry'),
+               **METHOD_FILTERS.get(method, {})}
+    programme = filters['programme'] if filters['programme'] in ['obligatory', 'voluntary'] else 'all'
+    return (filters['product'], programme, tuple(kwargs.get('year_list') or []), tuple(kwargs.get('country_list') or []), filters['country'])
+
+
+def run_plan(aggregator: DataAggregator, plan: list, out_dir: str, n_jobs: int = 1):
+    os.makedirs(out_dir, exist_ok=True)
+    groups = {}
+    for job in plan:
+        groups.setdefault(filter_key(job[1], job[2]), []).append(job)
+    products = {}
+    for key, jobs in groups.items():
+        products.setdefault(key[0], {})[key] = jobs
+
+    errors = []
+    for i, (product, product_groups) in enumerate(products.items()):
+        # the filter mask of every group is built once, by the first of its jobs reading it, and shared by the others.
+        # the groups of a product run side by side and their frames are read under the aggregator lock on first use,
+        # with a result cache only the jobs that miss it read them
+        for (_, programme, year_list, country_list, country) in product_groups:
+            aggregator.share(product, programme, list(year_list) or None, list(country_list) or None, country)
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(run_job, aggregator, job, out_dir): job[0] for jobs in product_groups.values() for job in jobs}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append((futures[future], repr(e)))
+        aggregator.unshare()
+        later = [frame for p in list(products)[i + 1:] for frame in PRODUCT_FRAMES[p]]
+        aggregator.release(*[frame for frame in PRODUCT_FRAMES[product] if frame not in later])
+
+    print(f'Wrote {len(plan) - len(errors)} of {len(plan)} reports to {out_dir}.')
+    for path, error in sorted(errors):
+        print(f'Report {path} failed: {error}')
+    return errors
+
+
+def run_job(aggregator: DataAggregator, job: tuple, out_dir: str):
+    path, method, kwargs = job
+    start = time.perf_counter()
+    res = getattr(aggregator, method)(**kwargs)
+    # a half written csv never replaces the previous one
+    file_path = os.path.join(out_dir, path)
+    tmp_path = f'{file_path}.tmp'
+    res.to_csv(tmp_path)
+    os.replace(tmp_path, file_path)
+    print(f'{path}: {len(res)} rows in {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Regenerate the csv tables of results/results.')
+    parser.add_argument('--data-dir', default='data/merged/final_dataset.pkl')
+    parser.add_argument('--milk-dir', default='data/merged/milk_3.pkl')
+    parser.add_argument('--butter-dir', default='data/merged/butter_3.pkl')
+    parser.add_argument('--store-dir', default=None)
+    parser.add_argument('--paramcodes', default='data/paramcodes.csv')
+    parser.add_argument('--out-dir', default='results/results')
+    parser.add_argument('--only', default='*', help='glob over the report file names')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--compact', action='store_true')
+    parser.add_argument('--chunked', action='store_true', help='stream the store partition by partition, needs --store-dir')
+    parser.add_argument('--backend', default='pandas', choices=['pandas', 'duckdb'])
+    parser.add_argument('--approximate', action='store_true', help='HyperLogLog sample counts, for drafts only')
+    parser.add_argument('--cache-dir', default=None, help='keep the results between runs, recomputed when the data or paramcodes change')
+    args = parser.parse_args()
+
+    aggregator = DataAggregator(args.data_dir, args.milk_dir, args.butter_dir, store_dir=args.store_dir, compact=args.compact, chunked=args.chunked, backend=args.backend, approximate=args.approximate, cache_dir=args.cache_dir, lazy=True)
+    plan = [job for job in report_plan(args.paramcodes) if fnmatch.fnmatch(job[0], args.only)]
+    run_plan(aggregator, plan, args.out_dir, args.jobs)
+    if aggregator.cache is not None:
+        print(aggregator.cache_report().to_string(index=False))
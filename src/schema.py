@@ -0,0 +1,109 @@
+import json
+import numpy as np
+import pandas as pd
+
+# columns stored as categories, columns of the same group share one dictionary
+CATEGORY_COLUMNS = {'sampCountry': 'country',
+                    'origCountry': 'country',
+                    'pesticideCode': 'pesticideCode',
+                    'progType': 'progType',
+                    'resType': 'resType',
+                    'productCode': 'productCode',
+                    'productTreat': 'productTreat',
+                    'efsaProductCode': 'efsaProductCode'}
+
+
+class CompactSchema:
+    def __init__(self, categories: dict = None, sample_ids: list = None):
+        self.categories = {} if categories is None else {group: sorted(values) for group, values in categories.items()}
+        # position in this index is the interned sample id, new ids are only appended so codes never change
+        self.sample_ids = pd.Index([] if sample_ids is None else sample_ids, dtype=object)
+
+    def fit(self, df: pd.DataFrame):
+        for col, group in CATEGORY_COLUMNS.items():
+            if col in df:
+                values = df[col].cat.categories if isinstance(df[col].dtype, pd.CategoricalDtype) else df[col].dropna().unique()
+                self.categories[group] = sorted(set(self.categories.get(group, [])) | set(values))
+        if 'sampleId' in df and not pd.api.types.is_integer_dtype(df['sampleId']):
+            new_ids = pd.Index(df['sampleId'].unique()).difference(self.sample_ids, sort=False)
+            self.sample_ids = self.sample_ids.append(new_ids.astype(object))
+        return self
+
+    def compact(self, df: pd.DataFrame, intern_samples: bool = True, downcast: bool = True):
+        df = df.copy()
+        for col, group in CATEGORY_COLUMNS.items():
+            if col in df and group in self.categories:
+                df[col] = df[col].astype(pd.CategoricalDtype(self.categories[group]))
+        if intern_samples and 'sampleId' in df and not pd.api.types.is_integer_dtype(df['sampleId']):
+            codes = self.sample_ids.get_indexer(df['sampleId'])
+            if (codes < 0).any():
+                raise ValueError('Sample ids missing from the schema, call fit first.')
+            df['sampleId'] = codes.astype(self._sample_dtype())
+        if downcast and 'resVal' in df and df['resVal'].dtype == 'float64' and self._round_trips(df['resVal']):
+            df['resVal'] = df['resVal'].astype('float32')
+        if 'year' in df:
+            df['year'] = df['year'].astype('int16')
+        return df
+
+    def restore(self, df: pd.DataFrame):
+        # inverse of compact, for any frame holding some of the compacted columns
+        df = df.copy()
+        if isinstance(df.columns, pd.CategoricalIndex):
+            df.columns = df.columns.astype(object)
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(object)
+        if 'sampleId' in df and pd.api.types.is_integer_dtype(df['sampleId']):
+            df['sampleId'] = self.decode_samples(df['sampleId'])
+        if 'resVal' in df and df['resVal'].dtype == 'float32':
+            df['resVal'] = self.restore_values(df['resVal'])
+        if 'year' in df and df['year'].dtype == 'int16':
+            df['year'] = df['year'].astype('int64')
+        return df
+
+    def decode_samples(self, codes: pd.Series):
+        return pd.Series(self.sample_ids.take(codes.to_numpy()), index=codes.index, dtype=object)
+
+    def restore_values(self, values: pd.Series):
+        # the shortest repr of a float32 gives back the reported decimal value when it has at most 7 significant digits,
+        # compact only downcasts columns where that holds for every value
+        return pd.Series(values.to_numpy().astype(str).astype('float64'), index=values.index)
+
+    def _round_trips(self, values: pd.Series):
+        # 1234.5678 or 0.123456789 would come back changed (and change comparisons with the limits), such columns stay float64
+        values = values.to_numpy()
+        with np.errstate(over='ignore'):
+            return np.array_equal(values.astype('float32').astype(str).astype('float64'), values, equal_nan=True)
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            json.dump({'categories': self.categories, 'sample_ids': self.sample_ids.tolist()}, f)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(categories=data['categories'], sample_ids=data['sample_ids'])
+
+    def _sample_dtype(self):
+        return 'int32' if len(self.sample_ids) < np.iinfo('int32').max else 'int64'
+
+
+def align_categories(dfs: list):
+    # pd.concat keeps category dtypes only when all frames share the same categories
+    for col in CATEGORY_COLUMNS:
+        frames = [df for df in dfs if col in df and isinstance(df[col].dtype, pd.CategoricalDtype)]
+        if frames:
+            categories = sorted(set().union(*[df[col].cat.categories for df in frames]))
+            for df in frames:
+                df[col] = df[col].cat.set_categories(categories)
+    return dfs
+
+
+def memory_report(df: pd.DataFrame):
+    usage = df.memory_usage(deep=True, index=False)
+    report = pd.DataFrame({'column': usage.index,
+                           'dtype': [str(df[col].dtype) for col in usage.index],
+                           'memory_mb': (usage.values / 2**20).round(2)})
+    total = pd.DataFrame({'column': ['total'], 'dtype': [''], 'memory_mb': [round(usage.sum() / 2**20, 2)]})
+    return pd.concat([report, total], ignore_index=True)
@@ -0,0 +1,107 @@
+import os
+import numpy as np
+import pandas as pd
+
+from src.cube import CELL_KEYS, MEASURES, _plain
+
+# HyperLogLog with 2**precision registers has a relative standard error of 1.04 / sqrt(2**precision),
+# 1.6% for the default 12 (within 3.3% for 95% of the counts). Counts below 2.5 * 2**precision use linear counting,
+# which is much closer, a few dozen samples come out exact or one off.
+PRECISION = 12
+
+
+class SampleSketches:
+    def __init__(self, cells: pd.DataFrame, pesticide_cells: pd.DataFrame, precision: int = PRECISION):
+        # sparse HyperLogLog registers, one row per (cell, register) that any sample reached, rank is the register value.
+        # merging sketches is a max of the ranks per register, so any roll-up of the cells is a groupby
+        self.cells = cells
+        # the same for the samples with a detection of each pesticide code
+        self.pesticide_cells = pesticide_cells
+        self.precision = precision
+
+    @classmethod
+    def build(cls, facts_by_product: dict, detections_by_product: dict, obligatory_years: dict, precision: int = PRECISION):
+        # facts_by_product holds the sample facts, detections_by_product the residue rows with a result, both per product
+        if not 11 <= precision <= 18:
+            raise ValueError('Sketch precision must be between 11 and 18.')
+        cells, pesticide_cells = [], []
+        for product, facts in facts_by_product.items():
+            facts = _plain(facts)
+            for programme, part in _programmes(facts, product, obligatory_years):
+                for measure, flag in MEASURES.items():
+                    rows = part if flag is None else part[part[flag]]
+                    cells.append(_registers(rows.assign(product=product, programme=programme, measure=measure),
+                                            CELL_KEYS + ['measure'], precision))
+        for product, detections in detections_by_product.items():
+            detections = _plain(detections[detections['resVal'].notna()][['sampleId', 'year', 'sampCountry', 'origCountry', 'progType', 'pesticideCode']])
+            for programme, part in _programmes(detections, product, obligatory_years):
+                pesticide_cells.append(_registers(part.assign(product=product, programme=programme), CELL_KEYS + ['pesticideCode'], precision))
+        return cls(pd.concat(cells, ignore_index=True), pd.concat(pesticide_cells, ignore_index=True), precision)
+
+    def counts(self, keys: list, product: str, programme: str = 'all', measure: str = 'samples', year_list: list = None, country_list: list = None, country: str = 'sampCountry'):
+        # estimate of groupby(keys)['sampleId'].nunique() over the matching samples, the Series SampleCube.counts gives
+        cells = _select(self.cells, product, programme, year_list, country_list, country)
+        cells = cells[cells['measure'] == measure]
+        return self.rollup(cells, keys)
+
+    def pesticide_counts(self, keys: list, product: str, programme: str = 'all', year_list: list = None, country_list: list = None, country: str = 'sampCountry', names=None):
+        # estimate of the samples with a detection per group of keys, keys may hold pesticideCode,
+        # or name with names the PesticideRegistry to merge the codes of one name
+        cells = _select(self.pesticide_cells, product, programme, year_list, country_list, country)
+        if names is not None:
+            cells = names.join(cells)
+        return self.rollup(cells, keys)
+
+    def rollup(self, cells: pd.DataFrame, keys: list):
+        m = 2 ** self.precision
+        registers = cells.groupby(list(keys) + ['register'], observed=True)['rank'].max().reset_index()
+        registers['weight'] = np.ldexp(1.0, -registers['rank'].to_numpy(dtype='int64'))
+        grouped = registers.groupby(list(keys), observed=True).agg(filled=('register', 'size'), weight=('weight', 'sum'))
+        zeros = m - grouped['filled'].to_numpy()
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / (grouped['weight'].to_numpy() + zeros)
+        small = (estimate <= 2.5 * m) & (zeros > 0)
+        estimate[small] = m * np.log(m / zeros[small])
+        res = pd.Series(np.rint(estimate).astype('int64'), index=grouped.index, name='sampleId')
+        return res[res > 0]
+
+    def save(self, path: str):
+        tmp_path = f'{path}.tmp'
+        pd.to_pickle({'cells': self.cells, 'pesticide_cells': self.pesticide_cells, 'precision': self.precision}, tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        data = pd.read_pickle(path)
+        return cls(data['cells'], data['pesticide_cells'], data['precision'])
+
+
+def _programmes(df: pd.DataFrame, product: str, obligatory_years: dict):
+    # the same programme subsets as the cube and the DataAggregator frames
+    yield 'all', df
+    years = obligatory_years.get(product)
+    if years is not None:
+        obligatory_year = df['year'].isin(years)
+        yield 'obligatory', df[obligatory_year & df['progType'].isin(['K009A', 'K018A'])]
+        yield 'voluntary', df[~obligatory_year | df['progType'].isin(['K005A', 'K018A'])]
+
+
+def _registers(df: pd.DataFrame, keys: list, precision: int):
+    # register = first precision bits of a 64 bit hash of the sample id, rank = leading zeros of the other bits + 1
+    df = df[df['sampleId'].notna()]
+    hashes = pd.util.hash_array(df['sampleId'].astype(str).to_numpy(dtype=object))
+    rest_bits = 64 - precision
+    rest = hashes & np.uint64(2 ** rest_bits - 1)
+    # rest fits the 53 bit mantissa, so frexp gives the exact position of its highest bit
+    _, exponent = np.frexp(rest.astype('float64'))
+    rank = np.where(rest == 0, rest_bits + 1, rest_bits - exponent + 1)
+    rows = df[keys].assign(register=(hashes >> np.uint64(rest_bits)).astype('int32'), rank=rank.astype('int8'))
+    return rows.groupby(keys + ['register'], dropna=False)['rank'].max().reset_index()
+
+
+def _select(cells: pd.DataFrame, product: str, programme: str, year_list: list, country_list: list, country: str):
+    mask = (cells['product'] == product) & (cells['programme'] == programme)
+    if year_list is not None:
+        mask &= cells['year'].isin(year_list)
+    if country_list is not None:
+        mask &= cells[country].isin(country_list)
+    return cells[mask]
@@ -0,0 +1,136 @@
+import numbers
+
+import duckdb
+import pandas as pd
+
+from src.paramcodes import get_registry
+from src.store import STRING_COLUMNS, list_partitions, read_store
+
+PROGRAMME_TYPES = {'obligatory': ['K009A', 'K018A'], 'voluntary': ['K005A', 'K018A']}
+
+
+class SqlBackend:
+    def __init__(self, aggregator, obligatory_years: dict, threads: int = None):
+        # queries read the partitioned store when the aggregator has one, the aggregator frames otherwise,
+        # duckdb scans those in place and runs every query on all cores unless threads is set
+        self.aggregator = aggregator
+        self.obligatory_years = obligatory_years
+        self.connection = duckdb.connect()
+        if threads is not None:
+            self.connection.execute(f'SET threads = {int(threads)}')
+
+    def pesticide_samples(self, frame: str, year_list: list, country_list: list, paramcodes_path: str, top_k: int, country: str = 'sampCountry'):
+        # 2.2, samples with each pesticide name per country and year, the top_k names of every group
+        sql = f'''
+            WITH counts AS (
+                SELECT d.{country}, d.year, p.name, COUNT(DISTINCT d.sampleId) AS n
+                FROM {{source}} d JOIN paramcodes p ON d.pesticideCode = p.code
+                WHERE {self._where(frame, year_list, country_list, country)} AND d.resVal IS NOT NULL AND p.name IS NOT NULL
+                GROUP BY d.{country}, d.year, p.name
+            )
+            SELECT {country}, year, name, n AS "Number of samples with pesticide"
+            FROM counts
+            QUALIFY row_number() OVER (PARTITION BY {country}, year ORDER BY n DESC, name) <= {int(top_k)}
+            ORDER BY {country}, year, n DESC, name
+        '''
+        return self._query(sql, frame, year_list, country_list, country, paramcodes_path)
+
+    def top_pesticide_samples(self, frame: str, year_list: list, country_list: list, top_k: int):
+        # 2.5, samples with each pesticide per origin country, for the pesticides in the top_k of any country
+        sql = f'''
+            WITH counts AS (
+                SELECT d.origCountry, d.pesticideCode, COUNT(DISTINCT d.sampleId) AS n
+                FROM {{source}} d
+                WHERE {self._where(frame, year_list, country_list, 'origCountry')} AND d.resVal IS NOT NULL AND d.pesticideCode IS NOT NULL
+                GROUP BY d.origCountry, d.pesticideCode
+            ), top AS (
+                SELECT DISTINCT pesticideCode
+                FROM counts
+                QUALIFY row_number() OVER (PARTITION BY origCountry ORDER BY n DESC, pesticideCode) <= {int(top_k)}
+            )
+            SELECT origCountry, pesticideCode, n AS pesticides_count
+            FROM counts
+            WHERE pesticideCode IN (SELECT pesticideCode FROM top)
+            ORDER BY origCountry, pesticideCode
+        '''
+        return self._query(sql, frame, year_list, country_list, 'origCountry')
+
+    def pesticide_results(self, frame: str, year_list: list, country_list: list):
+        # 7, detected results of each pesticide per origin country, most frequent first
+        sql = f'''
+            SELECT d.origCountry, d.pesticideCode, COUNT(d.sampleId) AS sample_count
+            FROM {{source}} d
+            WHERE {self._where(frame, year_list, country_list, 'origCountry')} AND d.resVal IS NOT NULL AND d.pesticideCode IS NOT NULL
+            GROUP BY d.origCountry, d.pesticideCode
+            ORDER BY d.origCountry, sample_count DESC, d.pesticideCode
+        '''
+        return self._query(sql, frame, year_list, country_list, 'origCountry')
+
+    def _query(self, sql: str, frame: str, year_list: list, country_list: list, country: str, paramcodes_path: str = None):
+        # a cursor per query, so jobs running in threads side by side do not share one
+        cursor = self.connection.cursor()
+        try:
+            source = self._source(frame, year_list, country_list, country)
+            if isinstance(source, pd.DataFrame):
+                cursor.register('residues', source)
+                source = 'residues'
+            if paramcodes_path is not None:
+                cursor.register('paramcodes', self._paramcodes(paramcodes_path))
+            res = cursor.execute(sql.replace('{source}', source)).df()
+        finally:
+            cursor.close()
+        # duckdb types the text columns of an empty frame (no partition file matched) as integers,
+        # the pandas code gives object columns there
+        if res.empty:
+            res = res.astype({col: object for col in res.columns if col in STRING_COLUMNS + ['name']})
+        return res
+
+    def _source(self, frame: str, year_list: list, country_list: list, country: str):
+        aggregator = self.aggregator
+        product = frame.split('_')[0] if frame != 'dataframe' else 'both'
+        if aggregator.store_dir is None:
+            return getattr(aggregator, f'{product}_dataframe' if product != 'both' else 'dataframe')
+        # only the partition files of the asked years (and reporting countries) are scanned
+        filters = aggregator.store_filters
+        years = [year for year in year_list if filters['year_list'] is None or year in filters['year_list']]
+        countries = filters['country_list']
+        if country == 'sampCountry':
+            countries = [c for c in country_list if countries is None or c in countries]
+        files = list_partitions(aggregator.store_dir, product, years, countries)
+        if not files:
+            return read_store(aggregator.store_dir, product, years, countries)
+        source = f'(SELECT * FROM read_parquet([{_values(files)}], hive_partitioning = false)'
+        if filters['programme_list'] is not None:
+            source += f' WHERE {_in("progType", filters["programme_list"])}'
+        return source + ')'
+
+    def _where(self, frame: str, year_list: list, country_list: list, country: str):
+        # the filters of the pandas code, plus the programme subset the frame stands for
+        conditions = [_in('d.year', year_list), _in(f'd.{country}', country_list)]
+        parts = frame.split('_')
+        if len(parts) == 3:
+            obligatory_years = self.obligatory_years[f'{parts[0]}_dataframe']
+            if parts[1] == 'obligatory':
+                conditions.append(f'({_in("d.year", obligatory_years)} AND {_in("d.progType", PROGRAMME_TYPES["obligatory"])})')
+            else:
+                conditions.append(f'({_in("d.year", obligatory_years, negate=True)} OR {_in("d.progType", PROGRAMME_TYPES["voluntary"])})')
+        return ' AND '.join(conditions)
+
+    def _paramcodes(self, path: str):
+        # the codes of the registry, a join on them gives the same rows as PesticideRegistry.join
+        registry = get_registry(path)
+        names = pd.Series(registry.names[:-1], dtype=object)
+        return pd.DataFrame({'code': registry.codes.to_numpy(dtype=object), 'name': names.where(names.notna(), None)})
+
+
+def _in(expression: str, values: list, negate: bool = False):
+    # expression [NOT] IN (values), like isin an empty list keeps no row (all rows negated),
+    # sql has no empty list and NOT IN (NULL) is never true
+    if not values:
+        return 'TRUE' if negate else 'FALSE'
+    return f'{expression} {"NOT IN" if negate else "IN"} ({_values(values)})'
+
+
+def _values(values: list):
+    # a sql list of literals, numbers as they are and strings quoted
+    return ', '.join(str(int(value)) if isinstance(value, numbers.Number) and not isinstance(value, bool) else "'" + str(value).replace("'", "''") + "'" for value in values)
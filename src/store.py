@@ -0,0 +1,122 @@
+import glob
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# same product split as milk_3.pkl / butter_3.pkl in analysis/transform_data.ipynb
+MILK_TREATMENTS = ['T100A', 'T150A', 'T999A']
+BUTTER_TREATMENTS = ['T152A', 'T134A']
+
+STRING_COLUMNS = ['sampleId', 'sampCountry', 'origCountry', 'productCode', 'efsaProductCode', 'productTreat', 'progType', 'pesticideCode', 'resType']
+FLOAT_COLUMNS = ['resVal', 'fatPerc']
+# partition of the rows without a sampCountry, a country list never selects it, like isin never keeps NaN
+NULL_PARTITION = '__null__'
+COLUMNS = ['sampleId', 'sampCountry', 'origCountry', 'productCode', 'efsaProductCode', 'productTreat', 'progType', 'pesticideCode', 'resVal', 'fatPerc', 'resType', 'year']
+
+SCHEMA = pa.schema([('rowId', pa.int64())] +
+                   [(col, pa.string()) if col in STRING_COLUMNS else (col, pa.float64()) if col in FLOAT_COLUMNS else (col, pa.int64())
+                    for col in COLUMNS])
+
+
+def product_of(df: pd.DataFrame):
+    product = pd.Series('other', index=df.index, dtype=object)
+    treat = df['productTreat'] if 'productTreat' in df else pd.Series(np.nan, index=df.index)
+    product[treat.isin(MILK_TREATMENTS) | df['productCode'].str.contains('A02L.*') | (df['productCode'] == 'A02MA')] = 'milk'
+    product[(df['productCode'] == 'A039C') | treat.isin(BUTTER_TREATMENTS)] = 'butter'
+    return product
+
+
+def partition_dir(store_dir: str, product: str, year: int, country: str):
+    return os.path.join(store_dir, f'product={product}', f'year={year}', f'sampCountry={country}')
+
+
+def write_partitions(df: pd.DataFrame, store_dir: str, year: int, source: str, first_row_id: int = 0, compression: str = 'zstd'):
+    # one file per source (country, year) file inside every product/year/sampCountry partition,
+    # so rewriting a single source never touches the data of another one
+    df = df.copy()
+    df['year'] = year
+    df['rowId'] = np.arange(first_row_id, first_row_id + len(df), dtype='int64')
+    for col in COLUMNS:
+        if col not in df:
+            df[col] = np.nan
+    for col in STRING_COLUMNS:
+        values = df[col].astype(object)
+        df[col] = values.where(values.isna(), values.astype(str))
+
+    products = product_of(df)
+    paths = []
+    for (product, country), part in df.groupby([products, 'sampCountry'], sort=True, dropna=False):
+        path = partition_dir(store_dir, product, year, NULL_PARTITION if pd.isna(country) else country)
+        os.makedirs(path, exist_ok=True)
+        file_path = os.path.join(path, f'part-{source}.parquet')
+        table = pa.Table.from_pandas(part[['rowId'] + COLUMNS], schema=SCHEMA, preserve_index=False)
+        pq.write_table(table, file_path, compression=compression)
+        paths.append(file_path)
+    return paths
+
+
+def remove_partitions(store_dir: str, year: int, source: str):
+    # the files written for one source file, before it is written again
+    for path in glob.glob(os.path.join(store_dir, 'product=*', f'year={year}', 'sampCountry=*', f'part-{source}.parquet')):
+        os.remove(path)
+
+
+def list_partitions(store_dir: str, product: str = None, year_list: list = None, country_list: list = None):
+    files = []
+    for product_dir in sorted(os.listdir(store_dir)):
+        if not product_dir.startswith('product='):
+            continue
+        if product not in (None, 'both') and product_dir != f'product={product}':
+            continue
+        for year_dir in sorted(os.listdir(os.path.join(store_dir, product_dir))):
+            if year_list is not None and int(year_dir.split('=')[1]) not in year_list:
+                continue
+            for country_dir in sorted(os.listdir(os.path.join(store_dir, product_dir, year_dir))):
+                if country_list is not None and country_dir.split('=')[1] not in country_list:
+                    continue
+                path = os.path.join(store_dir, product_dir, year_dir, country_dir)
+                files += [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.parquet')]
+    return files
+
+
+def read_store(store_dir: str, product: str = None, year_list: list = None, country_list: list = None, programme_list: list = None, columns: list = None):
+    files = list_partitions(store_dir, product, year_list, country_list)
+    columns = COLUMNS if columns is None else columns
+    if not files:
+        return pd.DataFrame({col: pd.Series(dtype=SCHEMA.field(col).type.to_pandas_dtype()) for col in columns})
+
+    # the columns come from the files, not from the directory names (the null partition holds NaN)
+    table = pq.read_table(files, schema=SCHEMA, columns=['rowId'] + columns, filters=_programme_filter(programme_list), partitioning=None)
+    return _to_pandas(table)
+
+
+def iter_store(store_dir: str, product: str = None, year_list: list = None, country_list: list = None, programme_list: list = None, columns: list = None):
+    # the rows of read_store one partition file at a time, each with its rowId index
+    columns = COLUMNS if columns is None else columns
+    for path in list_partitions(store_dir, product, year_list, country_list):
+        yield read_partition(path, programme_list, columns)
+
+
+def read_partition(path: str, programme_list: list = None, columns: list = None):
+    columns = COLUMNS if columns is None else columns
+    return _to_pandas(pq.read_table(path, schema=SCHEMA, columns=['rowId'] + columns, filters=_programme_filter(programme_list), partitioning=None))
+
+
+def _programme_filter(programme_list: list):
+    return [('progType', 'in', list(programme_list))] if programme_list is not None else None
+
+
+def _to_pandas(table: pa.Table):
+    df = table.to_pandas()
+    # restore the row order and index of final_dataset.pkl
+    df = df.sort_values('rowId').set_index('rowId')
+    df.index.name = None
+    for col in STRING_COLUMNS:
+        if col in df:
+            # arrow gives None for missing strings, the pickles hold NaN
+            values = df[col].to_numpy(dtype=object)
+            values[pd.isna(values)] = np.nan
+            df[col] = pd.Series(values, index=df.index, dtype=object)
+    return df
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+
+def grouped_top_k(df: pd.DataFrame, by: list, value: str, k, tie_break: list = None):
+    # rows with the k largest values of every group of by, ordered by group, value (largest first) and tie_break,
+    # rows that still tie keep the order of df. with tie_break=None this is
+    # df.sort_values(by + [value], ascending=[True, ..., False]).groupby(by).head(k), without sorting every group:
+    # the k-th largest value of every group with more than k rows is found first (see _thresholds), only the rows
+    # reaching it (ties included) are sorted. a list of k gives {k: rows} from one pass
+    ks = [k] if np.isscalar(k) else sorted(set(k))
+    k_max = max(ks)
+    by = [by] if isinstance(by, str) else list(by)
+
+    group = df.groupby(by, observed=True, sort=True).ngroup().to_numpy()
+    valid = ~np.isnan(group) if group.dtype.kind == 'f' else np.ones(len(group), dtype=bool)
+    group = np.where(valid, group, -1).astype('int64')
+    values = df[value].to_numpy(dtype='float64')
+    missing = np.isnan(values)
+    # missing values come last, like na_option='bottom'
+    filled = np.where(missing, -np.inf, values)
+
+    candidates = valid.copy()
+    sizes = np.bincount(group[valid], minlength=group.max() + 1 if len(group) else 0)
+    large = sizes > k_max
+    if large.any():
+        rows = np.flatnonzero(valid & large[np.maximum(group, 0)])
+        # a stable sort of small ints is a radix sort in numpy, up to 65536 groups
+        rows = rows[np.argsort(group[rows].astype(np.min_scalar_type(len(sizes))), kind='stable')]
+        threshold = _thresholds(filled[rows], sizes[large], k_max)
+        candidates[rows] = filled[rows] >= np.repeat(threshold, sizes[large])
+    positions = np.flatnonzero(candidates)
+
+    keys = [positions]
+    if tie_break:
+        keys += [pd.factorize(df[col].to_numpy()[positions], sort=True)[0] for col in reversed(tie_break)]
+    keys += [-filled[positions], missing[positions], group[positions]]
+    order = positions[np.lexsort(keys)]
+
+    # position of every candidate inside its group
+    ordered_group = group[order]
+    starts = np.flatnonzero(np.r_[True, ordered_group[1:] != ordered_group[:-1]]) if len(order) else np.array([], dtype='int64')
+    within = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    res = {top: df.iloc[order[within < top]] for top in ks}
+    return res[k] if np.isscalar(k) else res
+
+
+def _thresholds(values: np.ndarray, sizes: np.ndarray, k: int):
+    # k-th largest value of every run of values (the groups, one after the other, each longer than k),
+    # in at most k vectorized rounds: each round takes the max of the groups with fewer than k values above it so far
+    starts = np.r_[0, np.cumsum(sizes)[:-1]]
+    remaining = values.copy()
+    above = np.zeros(len(sizes), dtype='int64')
+    threshold = np.full(len(sizes), np.inf)
+    for _ in range(k):
+        active = above < k
+        if not active.any():
+            break
+        top = np.maximum.reduceat(remaining, starts)
+        threshold[active] = top[active]
+        hit = (remaining == np.repeat(top, sizes)) & np.repeat(active, sizes)
+        above += np.add.reduceat(hit.astype('int64'), starts)
+        # a group left with -inf only (missing values) takes all of them at once
+        remaining[hit] = -np.inf
+    return threshold
@@ -2,6 +2,7 @@ import plotly.express as px
 import plotly.graph_objects as go
 import plotly.io as pio
 import pandas as pd
+import numpy as np
 import pycountry
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
@@ -10,19 +11,39 @@ import seaborn as sns
 from matplotlib.colors import LinearSegmentedColormap
 from mpl_chord_diagram import chord_diagram
 
-def plot_map(country_codes_list, values_list, title, legend_label, custom_color_scale, text_list=None, save_path=None) :
-    def get_iso3(iso2_code):
-        try:
-            country = pycountry.countries.get(alpha_2=iso2_code)
-            return country.alpha_3
-        except:
-            return None
+# ISO2 -> ISO3 of every country pycountry knows, codes missing from it (XI) get no map area
+ISO3 = {country.alpha_2: country.alpha_3 for country in pycountry.countries}
 
+
+def plot_map(country_codes_list, values_list, title, legend_label, custom_color_scale, text_list=None, save_path=None) :
     try:
         pio.renderers.default = "notebook"
     except:
         pio.renderers.default = "png"
 
+    fig = map_figure(country_codes_list, values_list, title, legend_label, custom_color_scale, text_list)
+    
+    if save_path is not None:
+        fig.write_html(save_path)
+
+    try:
+        fig.show()
+        print("✓ Interactive map displayed successfully!")
+    except Exception as e:
+        print(f"Interactive display failed: {e}")
+        print("Trying static image display...")
+        try:
+            img_bytes = fig.to_image(format="png", width=1000, height=700)
+            from IPython.display import Image, display
+            display(Image(img_bytes))
+            print("✓ Static map displayed successfully!")
+        except Exception as e2:
+            print(f"Static display also failed: {e2}")
+            print("Please use the matplotlib alternative below.")
+
+
+def map_figure(country_codes_list, values_list, title, legend_label, custom_color_scale, text_list=None):
+    # the choropleth of plot_map, built without displaying it
     if text_list is not None:
         sample_data = pd.DataFrame({
             'country_code': country_codes_list,
@@ -35,7 +56,7 @@ def plot_map(country_codes_list, values_list, title, legend_label, custom_color_
             'value': values_list,
         })
 
-    sample_data['iso3_code'] = sample_data['country_code'].apply(get_iso3)
+    sample_data['iso3_code'] = sample_data['country_code'].map(ISO3)
 
     sample_data = sample_data.dropna(subset=['iso3_code'])
 
@@ -104,68 +125,28 @@ def plot_map(country_codes_list, values_list, title, legend_label, custom_color_
     width=1000,
     height=700
     )
-    
-    if save_path is not None:
-        fig.write_html(save_path)
-
-    try:
-        fig.show()
-        print("✓ Interactive map displayed successfully!")
-    except Exception as e:
-        print(f"Interactive display failed: {e}")
-        print("Trying static image display...")
-        try:
-            img_bytes = fig.to_image(format="png", width=1000, height=700)
-            from IPython.display import Image, display
-            display(Image(img_bytes))
-            print("✓ Static map displayed successfully!")
-        except Exception as e2:
-            print(f"Static display also failed: {e2}")
-            print("Please use the matplotlib alternative below.")
+    return fig
             
             
-def plot_chord(df: pd.DataFrame, product: str, country_type: str, title: str, top_k_countries: int = 5, top_k_pesticides: int = 5):
+def plot_chord(df: pd.DataFrame, product: str, country_type: str, title: str, top_k_countries: int = 5, top_k_pesticides: int = 5, weight: str = 'co_occurrence_count'):
+    chord_figure(df, product, country_type, title, top_k_countries, top_k_pesticides, weight)
+
+def chord_figure(df: pd.DataFrame, product: str, country_type: str, title: str, top_k_countries: int = 5, top_k_pesticides: int = 5, weight: str = 'co_occurrence_count'):
     if country_type == 'origin':
         country = "origCountry"
     elif country_type == 'reporting':
         country = 'sampCountry'
-    else:
+    elif country_type != 'pesticide':
         print('Wrong country type')
         return 
     
-    agg = df.groupby([country, "name"])["Number of samples with pesticide"].sum().reset_index()
-    country_totals = agg.groupby(country)["Number of samples with pesticide"].sum()
-
-    top_countries = country_totals.sort_values(ascending=False).head(top_k_countries).index
-    agg[country] = agg[country].where(agg[country].isin(top_countries), "Other countries")
-
-    agg = agg.groupby([country, "name"])["Number of samples with pesticide"].sum().reset_index()
-
-
-    top_pest = (
-        df.groupby("name")["Number of samples with pesticide"]
-        .sum()
-        .sort_values(ascending=False)
-        .head(top_k_pesticides)
-        .index
-    )
-    agg = agg[agg["name"].isin(top_pest)]
-
-    countries = agg[country].unique().tolist()
-    pesticides = agg["name"].unique().tolist()
-
-    nodes = countries + pesticides
-    node_index = {name: i for i, name in enumerate(nodes)}
-
-    matrix = [[0] * len(nodes) for _ in range(len(nodes))]
-
-    for _, row in agg.iterrows():
-        i = node_index[row[country]]
-        j = node_index[row["name"]]
-        matrix[i][j] = row["Number of samples with pesticide"]
-        matrix[j][i] = row["Number of samples with pesticide"]  
-
-    
+    if country_type == 'pesticide':
+        # df from DataAggregator.pesticide_co_occurrence, links between pesticides found in the same samples
+        countries = []
+        pesticides, matrix = co_occurrence_matrix(df, top_k_pesticides, weight)
+        nodes = pesticides
+    else:
+        countries, pesticides, nodes, matrix = country_pesticide_matrix(df, country, top_k_countries, top_k_pesticides)
 
     colors = []
     for i, node in enumerate(nodes):
@@ -188,10 +169,12 @@ def plot_chord(df: pd.DataFrame, product: str, country_type: str, title: str, to
             else:
                 colors.append(cm.tab20(i % 20))  # pesticide colors
 
-    plt.figure(figsize=(12,12))
+    # chord_diagram opens a figure of its own unless it gets the axes to draw on
+    fig, ax = plt.subplots(figsize=(12,12))
     plt.subplots_adjust(top=0.55)
     chord_diagram(
         matrix,
+        ax=ax,
         names=nodes,
         colors=colors,
         sort="size",      
@@ -200,15 +183,75 @@ def plot_chord(df: pd.DataFrame, product: str, country_type: str, title: str, to
         fontsize=10
     )
     plt.title(title)
+    return fig
+
+def country_pesticide_matrix(df: pd.DataFrame, country: str, top_k_countries: int, top_k_pesticides: int):
+    agg = df.groupby([country, "name"])["Number of samples with pesticide"].sum().reset_index()
+    country_totals = agg.groupby(country)["Number of samples with pesticide"].sum()
+
+    top_countries = country_totals.sort_values(ascending=False).head(top_k_countries).index
+    agg[country] = agg[country].where(agg[country].isin(top_countries), "Other countries")
+
+    agg = agg.groupby([country, "name"])["Number of samples with pesticide"].sum().reset_index()
+
+
+    top_pest = (
+        df.groupby("name")["Number of samples with pesticide"]
+        .sum()
+        .sort_values(ascending=False)
+        .head(top_k_pesticides)
+        .index
+    )
+    agg = agg[agg["name"].isin(top_pest)]
+
+    countries = agg[country].unique().tolist()
+    pesticides = agg["name"].unique().tolist()
+
+    nodes = countries + pesticides
+    node_index = {name: i for i, name in enumerate(nodes)}
+
+    matrix = chord_matrix(agg, country, node_index)
+    return countries, pesticides, nodes, matrix
+
+def co_occurrence_matrix(df: pd.DataFrame, top_k_pesticides: int, weight: str = 'co_occurrence_count'):
+    # symmetric pesticide-pesticide matrix of the top_k_pesticides with the most links, counts add up over the groups of df
+    pairs = df.groupby(['pesticide_a', 'pesticide_b'])[weight].sum().reset_index()
+    degree = pd.concat([pairs.set_index('pesticide_a')[weight], pairs.set_index('pesticide_b')[weight]]).groupby(level=0).sum()
+    pesticides = degree.sort_values(ascending=False).head(top_k_pesticides).index.tolist()
+    pairs = pairs[pairs['pesticide_a'].isin(pesticides) & pairs['pesticide_b'].isin(pesticides)]
+    node_index = {name: i for i, name in enumerate(pesticides)}
+    matrix = np.zeros((len(pesticides), len(pesticides)), dtype=pairs[weight].dtype)
+    i = pairs['pesticide_a'].map(node_index).to_numpy()
+    j = pairs['pesticide_b'].map(node_index).to_numpy()
+    matrix[i, j] = pairs[weight].to_numpy()
+    matrix[j, i] = pairs[weight].to_numpy()
+    return pesticides, matrix
+
+def chord_matrix(agg: pd.DataFrame, country: str, node_index: dict):
+    # symmetric country-pesticide adjacency matrix filled with one vectorized assignment
+    matrix = np.zeros((len(node_index), len(node_index)), dtype=agg["Number of samples with pesticide"].dtype)
+    i = agg[country].map(node_index).to_numpy()
+    j = agg["name"].map(node_index).to_numpy()
+    matrix[i, j] = agg["Number of samples with pesticide"].to_numpy()
+    matrix[j, i] = agg["Number of samples with pesticide"].to_numpy()
+    return matrix
+
+def stats_labels(df: pd.DataFrame):
+    return (
+        "L=" + df['limit_samples'].astype(int).astype(str)
+        + " \nV=" + df['VAL_samples'].astype(int).astype(str)
+        + " \n∑=" + df['total_samples'].astype(int).astype(str)
+    )
 
 def plot_stats_heatmap(df, country, product, title):
-    plt.figure(figsize=(10, 18))
+    stats_heatmap_figure(df, country, product, title)
+    plt.show()
+
+def stats_heatmap_figure(df, country, product, title):
+    fig = plt.figure(figsize=(10, 18))
 
     df_labels = df.copy()
-    df_labels['label'] = df_labels.apply(
-        lambda x: f"L={int(x['limit_samples'])} \nV={int(x['VAL_samples'])} \n∑={int(x['total_samples'])}", 
-        axis=1
-    )
+    df_labels['label'] = stats_labels(df_labels)
 
     pivot = df.pivot_table(index=country, columns='year', values='limit_samples', aggfunc='first')
     pivot = pivot.astype(float) 
@@ -242,4 +285,4 @@ def plot_stats_heatmap(df, country, product, title):
     plt.title("L - number of samples exceeding pesticides' limits, V - number of samples with pesticide detected, ∑ - total number of samples ")
     plt.tight_layout()
     plt.subplots_adjust(right=0.98, bottom=0.08, top=0.92, left=0.15)
-    plt.show()
\ No newline at end of file
+    return fig
\ No newline at end of file